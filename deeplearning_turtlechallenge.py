@@ -92,7 +92,6 @@ import torch
 from pytorch_pretrained_biggan import (
     BigGAN,
     truncated_noise_sample,
-    convert_to_images,
     one_hot_from_int,
 )
 
@@ -110,39 +109,209 @@ To save time and memory, we will only generate 30 different background images.
 Feel free to change this setup as needed.
 """
 
+# Regenerating 30000 backgrounds on every run and keeping all of them as PIL
+# images in memory is slow and memory hungry. Instead, the backgrounds are
+# written to an on-disk store of shards: every shard is a uint8 .npy array of
+# shape (N, 256, 256, 3) plus a (N, 2) array with the seed and the ImageNet
+# class of every image. Each image is fully determined by its seed, so a
+# partial run can be resumed shard by shard, and later runs just memory-map
+# the shards instead of running the GAN again.
+
+import json
+import os
+from torch.nn import Linear, Module
+from torch.nn import functional as F
+
+# Small stand-in for BigGAN with the same call signature, so the background
+# store can be tested on a CPU-only machine
+class TinyBackgroundGenerator(Module):
+    def __init__(self, dim_z=128, num_classes=1000, resolution=256):
+        super().__init__()
+        self.linear = Linear(dim_z + num_classes, 3 * 8 * 8)
+        self.resolution = resolution
+
+    def forward(self, noise_vector, class_vector, truncation):
+        x = self.linear(torch.cat([noise_vector, class_vector], 1)).view(-1, 3, 8, 8)
+        return torch.tanh(F.interpolate(x, size=self.resolution, mode='bilinear', align_corners=False))
+
+def generate_background_batch(model, seeds, truncation):
+    # BigGAN uses imagenet and hence each image gets one of 1000 categories
+    classes = np.array([np.random.RandomState(seed).randint(0, 1000) for seed in seeds])
+    class_vector = torch.from_numpy(one_hot_from_int(classes, batch_size=len(seeds))).to(device)
+    noise_vector = torch.from_numpy(np.concatenate([
+        truncated_noise_sample(truncation=truncation, batch_size=1, seed=int(seed)) for seed in seeds
+    ])).to(device)
+    with torch.no_grad():
+        output = model(noise_vector, class_vector, truncation)
+    # same conversion as pytorch_pretrained_biggan's convert_to_images, but kept
+    # as uint8 arrays
+    images = ((output + 1) / 2 * 256).clamp(0, 255).byte().permute(0, 2, 3, 1).cpu().numpy()
+    return images, classes
+
+def is_out_of_memory(error):
+    message = str(error)
+    return 'out of memory' in message or "can't allocate memory" in message
+
+# Doubles the batch size until the generator runs out of memory or
+# max_batch_size is reached, and returns the largest batch size that worked.
+# Only meant for GPUs, where running out of memory raises an error.
+def find_max_batch_size(model, truncation, max_batch_size=256):
+    batch_size, largest = 1, None
+    while batch_size <= max_batch_size:
+        try:
+            generate_background_batch(model, np.arange(batch_size), truncation)
+        except RuntimeError as e:
+            if not is_out_of_memory(e):
+                raise
+            break
+        finally:
+            if device.type == "cuda":
+                torch.cuda.empty_cache()
+        largest = batch_size
+        batch_size *= 2
+    if largest is None:
+        raise RuntimeError("The background generator doesn't fit into memory even with batch size 1")
+    return largest
+
+# On CPU, larger batches barely speed up the generator, and with Linux memory
+# overcommit running out of memory gets the process killed instead of raising,
+# so nothing is probed: the batch size is what fits into the available memory,
+# with about bytes_per_image per image (BigGAN-deep at 256x256), and at most
+# max_batch_size
+def cpu_batch_size(max_batch_size=8, bytes_per_image=256 * 2 ** 20):
+    try:
+        available = os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError):
+        return 1
+    return int(max(1, min(max_batch_size, available // 2 // bytes_per_image)))
+
+def background_shard_paths(store_dir, shard_idx):
+    prefix = os.path.join(store_dir, 'shard_{:05d}'.format(shard_idx))
+    return prefix + '_images.npy', prefix + '_labels.npy'
+
+# Writes an array to a temporary file first, so an interrupted run never
+# leaves a truncated shard behind
+def save_array_atomically(path, array):
+    with open(path + '.tmp', 'wb') as f:
+        np.save(f, array)
+    os.replace(path + '.tmp', path)
+
+# Checks that the store was written with config and returns the stored
+# config. Besides config it may contain settings that don't change the images,
+# like the batch sizes chosen for the generator.
+def check_background_store_config(store_dir, config):
+    os.makedirs(store_dir, exist_ok=True)
+    config_path = os.path.join(store_dir, 'config.json')
+    if os.path.exists(config_path):
+        with open(config_path) as f:
+            stored_config = json.load(f)
+        if {key: stored_config.get(key) for key in config} != config:
+            raise ValueError("{} was written with {}, not {}".format(store_dir, stored_config, config))
+        return stored_config
+    write_background_store_config(store_dir, config)
+    return dict(config)
+
+def write_background_store_config(store_dir, config):
+    config_path = os.path.join(store_dir, 'config.json')
+    with open(config_path + '.tmp', 'w') as f:
+        json.dump(config, f)
+    os.replace(config_path + '.tmp', config_path)
+
+def background_shards_complete(store_dir, num_images, shard_size):
+    num_shards = (num_images + shard_size - 1) // shard_size
+    return all(os.path.exists(background_shard_paths(store_dir, i)[0]) for i in range(num_shards))
+
+# Generates num_images backgrounds into store_dir, skipping the shards that
+# already exist. Image i uses the seed base_seed + i. The batch size is chosen
+# once per device type and stored in config.json, so resumed runs reuse it.
+def generate_background_shards(model, store_dir, num_images, shard_size=1024, truncation=0.4,
+                               base_seed=42, max_batch_size=256):
+    config = check_background_store_config(store_dir, {
+        'num_images': num_images, 'shard_size': shard_size, 'truncation': truncation, 'base_seed': base_seed,
+    })
+    batch_size = config.get('batch_size', {}).get(device.type)
+    num_shards = (num_images + shard_size - 1) // shard_size
+    for shard_idx in range(num_shards):
+        images_path, labels_path = background_shard_paths(store_dir, shard_idx)
+        if os.path.exists(images_path):
+            continue
+        if batch_size is None:
+            if device.type == "cuda":
+                batch_size = find_max_batch_size(model, truncation, max_batch_size)
+            else:
+                batch_size = cpu_batch_size(min(max_batch_size, 8))
+            config.setdefault('batch_size', {})[device.type] = batch_size
+            write_background_store_config(store_dir, config)
+            print("Generating backgrounds with batch size {}".format(batch_size))
+        shard_seeds = base_seed + np.arange(shard_idx * shard_size, min((shard_idx + 1) * shard_size, num_images))
+        shard_images, shard_classes = [], []
+        for batch_start in range(0, len(shard_seeds), batch_size):
+            images, classes = generate_background_batch(
+                model, shard_seeds[batch_start:batch_start + batch_size], truncation)
+            shard_images.append(images)
+            shard_classes.append(classes)
+        # the images are written last, their presence marks a complete shard
+        save_array_atomically(labels_path, np.stack([shard_seeds, np.concatenate(shard_classes)], 1))
+        save_array_atomically(images_path, np.concatenate(shard_images))
+
+# Memory-maps all shards of a store, returns the list of image arrays and the
+# (seed, class) labels of all images
+def load_background_shards(store_dir):
+    images, labels = [], []
+    shard_idx = 0
+    while os.path.exists(background_shard_paths(store_dir, shard_idx)[0]):
+        images_path, labels_path = background_shard_paths(store_dir, shard_idx)
+        images.append(np.load(images_path, mmap_mode='r'))
+        labels.append(np.load(labels_path))
+        shard_idx += 1
+    return images, np.concatenate(labels) if labels else np.zeros((0, 2), dtype=np.int64)
+
+# Read-only sequence of PIL images over memory-mapped shards. Images are only
+# read from disk when they are accessed.
+class BackgroundShardImages:
+    def __init__(self, shards):
+        self.shards = shards
+        self.offsets = np.cumsum([0] + [len(shard) for shard in shards])
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(idx)
+        shard_idx = np.searchsorted(self.offsets, idx, side='right') - 1
+        return Image.fromarray(np.asarray(self.shards[shard_idx][idx - self.offsets[shard_idx]]))
+
 ## NOTE: This section can be skipped to save time - Only used for training
 # Using 30000 backgroung images as opposed to 30
 
-# load the 256x256 model
-model = BigGAN.from_pretrained('biggan-deep-256').to(device).eval()
-
-# every time we will run with batch size of 3 in order to not run out of memory
-num_passes = 10000 # using 30000 instead of 30 training images
-batch_size = 3
+num_background_images = 30000 # using 30000 instead of 30 training images
 
 # default noise value from the provided repository
 truncation = 0.4
 
-background_images = []
+# set to False to test the background store on a CPU-only machine
+use_biggan = True
+background_store = 'backgrounds/biggan-deep-256' if use_biggan else 'backgrounds/tiny'
 
-for _ in range(num_passes):
-    # BigGAN uses imagenet and hence each time we will choose one of 1000 categories
-    class_vector = torch.from_numpy(
-        one_hot_from_int(np.random.randint(0, 1000, size=batch_size), batch_size=batch_size)
-    ).to(device)
-    noise_vector = torch.from_numpy(
-        truncated_noise_sample(truncation=truncation, batch_size=batch_size)
-    ).to(device)
+if not background_shards_complete(background_store, num_background_images, shard_size=1024):
+    # load the 256x256 model
+    if use_biggan:
+        model = BigGAN.from_pretrained('biggan-deep-256').to(device).eval()
+    else:
+        model = TinyBackgroundGenerator().to(device).eval()
 
-    # Generate the images and convert them to PIL image
-    with torch.no_grad():
-        output = model(noise_vector, class_vector, truncation).cpu()
-        background_images.extend(convert_to_images(output))
+    generate_background_shards(model, background_store, num_background_images, truncation=truncation)
 
-# We won't need the GAN model anymore,
-# so we can safely delete it and free up some memory
-del model
-torch.cuda.empty_cache()
+    # We won't need the GAN model anymore,
+    # so we can safely delete it and free up some memory
+    del model
+    torch.cuda.empty_cache()
+
+background_shards, background_labels = load_background_shards(background_store)
+background_images = BackgroundShardImages(background_shards)
 
 ## NOTE: This section can be skipped to save time - Only used for training
 
@@ -160,20 +329,36 @@ tensor_transform = transforms.ToTensor()
 
 # Adding random rotate and flip
 
-def random_paste(background_image, turtle_image, min_scale=0.25, max_scale=0.65):
-    """Randomly scales and pastes the turtle image onto the background image"""
-    if random.randint(0, 2):
+# The random flip, scale, rotation and position of one random_paste call, drawn
+# in the same order as random_paste always did
+def random_paste_params(turtle_size, min_scale=0.25, max_scale=0.65, rng=random):
+    w, h = turtle_size
+    params = {'flip': bool(rng.randint(0, 2))}
+    params['new_w'] = int(rng.uniform(min_scale, max_scale) * w)
+    params['new_h'] = int(rng.uniform(min_scale, max_scale) * h)
+    params['angle'] = rng.uniform(0, 360)
+    params['start_w'] = rng.randint(0, w - params['new_w'])
+    params['start_h'] = rng.randint(0, h - params['new_h'])
+    params['background_angle'] = rng.uniform(0, 360)
+    return params
+
+def random_paste(background_image, turtle_image, min_scale=0.25, max_scale=0.65, rng=random, params=None):
+    """Randomly scales and pastes the turtle image onto the background image
+
+    params: the output of random_paste_params, to paste with fixed parameters
+    """
+    if params is None:
+        params = random_paste_params(turtle_image.size, min_scale, max_scale, rng)
+    if params['flip']:
         turtle_image = turtle_image.transpose(Image.FLIP_LEFT_RIGHT)
     w, h = turtle_image.size
     # first, we will randomly downscale the turtle image
-    new_w = int(random.uniform(min_scale, max_scale) * w)
-    new_h = int(random.uniform(min_scale, max_scale) * h)
-    angle = random.uniform(0, 360)
-    resized_turtle_image = turtle_image.resize((new_w, new_h)).rotate(angle)
+    new_w, new_h = params['new_w'], params['new_h']
+    # rotate keeps the new_w x new_h size, so the rotated turtle is clipped
+    resized_turtle_image = turtle_image.resize((new_w, new_h)).rotate(params['angle'])
 
     # second, will randomly choose the locations where to paste the new image
-    start_w = random.randint(0, w - new_w)
-    start_h = random.randint(0, h - new_h)
+    start_w, start_h = params['start_w'], params['start_h']
 
     # third, will create the blank canvas of the same size as the original image
     canvas_image = Image.new('RGBA', (w, h))
@@ -183,28 +368,33 @@ def random_paste(background_image, turtle_image, min_scale=0.25, max_scale=0.65)
 
     # Turtle image is of mode RGBA, while background image is of mode RGB;
     # `.paste` requires both of them to be of the same type.
-    angle = random.uniform(0, 360)
-    background_image = background_image.rotate(angle)
+    background_image = background_image.rotate(params['background_angle'])
     background_image = background_image.copy().convert('RGBA')
     # finally, will paste the resized turtle onto the background image
     background_image.paste(resized_turtle_image, (start_w, start_h), resized_turtle_image)
     return background_image, canvas_image
 
-## NOTE: This section can be skipped to save time - Only used for training
-
-training_set = []  # image, segmentation mask
-
-for background_image in background_images:
-  # paste the turtle onto background image
-  aug_image, aug_mask = random_paste(background_image.copy(), turtle_image_256x256.copy())
+def make_training_pair(aug_image, aug_mask):
   # convert PIL images to pytorch tensors
-  training_pair = [
+  return [
       tensor_transform(aug_image)[:3],  # keep the rgb only
       # For the mask, we only need the last (4th) channel,
       # and we will encode the mask as boolean
       tensor_transform(aug_mask)[-1:] > 0,
   ]
-  training_set.append(training_pair)
+
+## NOTE: This section can be skipped to save time - Only used for training
+
+# Precomputing the composites for all 30000 backgrounds holds several GB of
+# float tensors in memory, and every epoch sees the same augmentation.
+# Training composites them lazily instead (see RandomPasteTurtleDataset
+# below), so only a few samples are created here to visualise them.
+training_set = []  # image, segmentation mask
+
+for i in np.random.choice(len(background_images), size=9, replace=False):
+  # paste the turtle onto background image
+  aug_image, aug_mask = random_paste(background_images[i].copy(), turtle_image_256x256.copy())
+  training_set.append(make_training_pair(aug_image, aug_mask))
 
 ## NOTE: This section can be skipped to save time - Only used for training
 
@@ -223,6 +413,164 @@ plt.imshow(torchvision.utils.make_grid(sample_images, nrow=3).permute(1, 2, 0).c
 plt.subplot(122)
 plt.imshow(torchvision.utils.make_grid(sample_masks, nrow=3).permute(1, 2, 0).float().cpu().numpy())
 
+# random_paste composites one image at a time in PIL and dominates the dataset
+# creation time. random_paste_batch does the same flip, scale, rotation and
+# translation for a whole batch with tensor ops: the inverse transform from
+# the canvas to the turtle template is built as one affine matrix per sample,
+# and the template is sampled with grid_sample. It returns the image and mask
+# tensors directly, in the same format as make_training_pair. Resampling is
+# bilinear for the turtle, while PIL resizes it bicubically and then rotates
+# it with nearest neighbour, so individual pixels differ but the mask
+# statistics match.
+#
+# On a GPU the training loader composites with random_paste_batch
+# (RandomPasteBatchCollate below). On CPU it is about half as fast as PIL, so
+# CPU training keeps random_paste in the DataLoader workers.
+
+import math
+import time
+
+# Affine matrices mapping normalized canvas coordinates to normalized source
+# coordinates for a box of box_w x box_h pixels centred at (center_x,
+# center_y) on a canvas_w x canvas_h canvas, rotated counter-clockwise by
+# angle degrees like PIL's rotate
+def rotated_box_affine(angle, box_w, box_h, center_x, center_y, canvas_w, canvas_h):
+  radians = -angle * math.pi / 180
+  cos, sin = torch.cos(radians), torch.sin(radians)
+  offset_x = canvas_w / 2 - center_x
+  offset_y = canvas_h / 2 - center_y
+  theta = torch.stack([
+      torch.stack([cos * canvas_w / box_w, sin * canvas_h / box_w, 2 * (cos * offset_x + sin * offset_y) / box_w], -1),
+      torch.stack([-sin * canvas_w / box_h, cos * canvas_h / box_h, 2 * (-sin * offset_x + cos * offset_y) / box_h], -1),
+  ], -2)
+  return theta
+
+# Batched random_paste_params: a dict of B-element tensors
+def random_paste_batch_params(b, turtle_size, min_scale=0.25, max_scale=0.65, generator=None):
+  w, h = turtle_size
+
+  def uniform(low, high):
+    return low + (high - low) * torch.rand(b, generator=generator)
+
+  params = {'flip': torch.rand(b, generator=generator) < 2 / 3}
+  params['new_w'] = torch.floor(uniform(min_scale, max_scale) * w)
+  params['new_h'] = torch.floor(uniform(min_scale, max_scale) * h)
+  params['angle'] = uniform(0, 360)
+  params['start_w'] = torch.floor(uniform(0, 1) * (w - params['new_w'] + 1))
+  params['start_h'] = torch.floor(uniform(0, 1) * (h - params['new_h'] + 1))
+  params['background_angle'] = uniform(0, 360)
+  return params
+
+def random_paste_batch(background_images, turtle_image, min_scale=0.25, max_scale=0.65, generator=None, params=None):
+  """Randomly scales and pastes the turtle template onto a batch of background images
+
+  background_images: Bx3xHxW float tensor in [0, 1] or uint8 tensor
+  turtle_image: 4xhxw float RGBA tensor in [0, 1], e.g. tensor_transform(turtle_image_256x256)
+  params: the output of random_paste_batch_params, to paste with fixed parameters
+  """
+  if background_images.dtype == torch.uint8:
+    background_images = background_images.float() / 255
+  b, _, canvas_h, canvas_w = background_images.shape
+  h, w = turtle_image.shape[-2:]
+  device = background_images.device
+  if params is None:
+    params = random_paste_batch_params(b, (w, h), min_scale, max_scale, generator)
+  flip, new_w, new_h, angle, start_w, start_h, background_angle = (
+      torch.as_tensor(params[key]).to(device) for key in
+      ('flip', 'new_w', 'new_h', 'angle', 'start_w', 'start_h', 'background_angle'))
+  new_w, new_h, angle, start_w, start_h, background_angle = (
+      x.float() for x in (new_w, new_h, angle, start_w, start_h, background_angle))
+
+  # a flipped template is the original template sampled at mirrored x
+  theta = rotated_box_affine(angle, new_w, new_h, start_w + new_w / 2, start_h + new_h / 2, canvas_w, canvas_h)
+  theta[:, 0] *= torch.where(flip, -1.0, 1.0)[:, None]
+  grid = F.affine_grid(theta, (b, 4, canvas_h, canvas_w), align_corners=False)
+  # all samples read the same template, so the grids are stacked along the
+  # height instead of copying the template b times
+  turtle = F.grid_sample(turtle_image.to(device)[None], grid.reshape(1, b * canvas_h, canvas_w, 2), align_corners=False)
+  turtle = turtle.view(4, b, canvas_h, canvas_w).transpose(0, 1)
+  # PIL rotates the turtle within its new_w x new_h box, so whatever rotates
+  # out of the box is cut off
+  cols = torch.arange(canvas_w, device=device)[None]
+  rows = torch.arange(canvas_h, device=device)[None]
+  in_cols = (cols >= start_w[:, None]) & (cols < (start_w + new_w)[:, None])
+  in_rows = (rows >= start_h[:, None]) & (rows < (start_h + new_h)[:, None])
+  turtle = turtle * (in_rows[:, :, None] & in_cols[:, None, :])[:, None]
+
+  full = torch.full((b,), float(canvas_w), device=device), torch.full((b,), float(canvas_h), device=device)
+  theta = rotated_box_affine(background_angle, full[0], full[1], full[0] / 2, full[1] / 2, canvas_w, canvas_h)
+  grid = F.affine_grid(theta, (b, 3, canvas_h, canvas_w), align_corners=False)
+  # PIL rotates the background with nearest neighbour resampling as well
+  background = F.grid_sample(background_images, grid, mode='nearest', align_corners=False)
+
+  alpha = turtle[:, 3:]
+  images = background * (1 - alpha) + turtle[:, :3] * alpha
+  return images, alpha > 0
+
+## NOTE: Only used for verification. This section can be skipped.
+
+# Mask coverage and placement of the turtle (mask centroid) from the PIL and
+# the tensor compositor, over the same backgrounds
+def mask_statistics(masks):
+  masks = masks.float()
+  coverage = masks.mean((1, 2, 3))
+  rows = torch.arange(masks.shape[-2], dtype=torch.float32)[:, None]
+  cols = torch.arange(masks.shape[-1], dtype=torch.float32)[None]
+  area = masks.sum((1, 2, 3)).clamp(min=1)
+  centroid_row = (masks[:, 0] * rows).sum((1, 2)) / area
+  centroid_col = (masks[:, 0] * cols).sum((1, 2)) / area
+  return torch.stack([coverage, centroid_row, centroid_col], 1)
+
+num_parity_samples = 500
+turtle_template = tensor_transform(turtle_image_256x256)
+parity_backgrounds = [background_images[i] for i in range(num_parity_samples)]
+parity_rng = random.Random(0)
+parity_params = [random_paste_params(turtle_image_256x256.size, rng=parity_rng) for _ in parity_backgrounds]
+pil_masks = torch.stack([
+    make_training_pair(*random_paste(background.copy(), turtle_image_256x256.copy(), params=params))[1]
+    for background, params in zip(parity_backgrounds, parity_params)
+])
+batch_backgrounds = torch.stack([tensor_transform(background) for background in parity_backgrounds])
+batch_params = {key: torch.tensor([params[key] for params in parity_params]) for key in parity_params[0]}
+_, tensor_masks = random_paste_batch(batch_backgrounds, turtle_template, params=batch_params)
+
+# With the same flip, scale, angle and offset the masks only differ by the
+# resampling along the turtle outline
+union = (pil_masks | tensor_masks).sum((1, 2, 3)).float()
+parity_ious = (pil_masks & tensor_masks).sum((1, 2, 3)).float() / union.clamp(min=1)
+print("IoU of the PIL and tensor masks: mean {:.3f}, min {:.3f}".format(parity_ious.mean(), parity_ious.min()))
+assert parity_ious.mean() > 0.9 and torch.quantile(parity_ious, 0.05) > 0.8
+
+# and with independent random parameters the distributions match
+_, tensor_masks = random_paste_batch(batch_backgrounds, turtle_template, generator=torch.Generator().manual_seed(0))
+pil_stats, tensor_stats = mask_statistics(pil_masks), mask_statistics(tensor_masks)
+print("mean coverage / centroid row / centroid col, PIL:", pil_stats.mean(0).tolist(), "tensor:", tensor_stats.mean(0).tolist())
+print("std  coverage / centroid row / centroid col, PIL:", pil_stats.std(0).tolist(), "tensor:", tensor_stats.std(0).tolist())
+# the means differ by a few standard errors at most
+standard_error = pil_stats.std(0) * math.sqrt(2 / num_parity_samples)
+assert ((pil_stats.mean(0) - tensor_stats.mean(0)).abs() < 4 * standard_error).all()
+
+## NOTE: Only used for benchmarking. This section can be skipped.
+
+def benchmark_random_paste(num_samples=512, batch_size=128):
+  backgrounds = [background_images[i] for i in range(num_samples)]
+  start = time.perf_counter()
+  for background in backgrounds:
+    make_training_pair(*random_paste(background.copy(), turtle_image_256x256.copy()))
+  pil_time = time.perf_counter() - start
+
+  batch_backgrounds = torch.stack([torch.from_numpy(np.asarray(background)).permute(2, 0, 1) for background in backgrounds])
+  template = tensor_transform(turtle_image_256x256).to(device)
+  start = time.perf_counter()
+  for batch_start in range(0, num_samples, batch_size):
+    random_paste_batch(batch_backgrounds[batch_start:batch_start + batch_size].to(device), template)
+  if device.type == "cuda":
+    torch.cuda.synchronize()
+  tensor_time = time.perf_counter() - start
+  print("PIL: {:.0f} samples/s, tensor: {:.0f} samples/s".format(num_samples / pil_time, num_samples / tensor_time))
+
+benchmark_random_paste()
+
 """# Test Image
 Now, let's load the test image. As mentioned above, it is of a slightly higher 512x512 resolution.
 """
@@ -241,8 +589,7 @@ test_image
 # import torch modules
 
 from torch.nn import Conv2d, ConvTranspose2d, MaxPool2d, ReLU
-from torch.nn import Module, ModuleList
-from torch.nn import functional as F
+from torch.nn import ModuleList
 from torch.nn import BCEWithLogitsLoss
 from torch.optim import Adam
 from torchvision.transforms import CenterCrop
@@ -263,11 +610,80 @@ class TurtleDataset(Dataset):
     def __len__(self):
         return len(self.images)
 
+# Composites the turtle onto the background in __getitem__, so every epoch
+# sees a fresh augmentation. The backgrounds stay uint8 (e.g. the memory-mapped
+# BackgroundShardImages), which needs an order of magnitude less memory than
+# the precomputed float tensors of TurtleDataset.
+class RandomPasteTurtleDataset(Dataset):
+    def __init__(self, background_images, turtle_image, seed=42):
+        self.background_images = background_images
+        self.turtle_image = turtle_image
+        self.rng = random.Random(seed)
+
+    def __getitem__(self, idx):
+        aug_image, aug_mask = random_paste(
+            self.background_images[idx].copy(), self.turtle_image.copy(), rng=self.rng)
+        img, mask = make_training_pair(aug_image, aug_mask)
+        return img, mask.float()
+
+    def __len__(self):
+        return len(self.background_images)
+
+# Every DataLoader worker reseeds its copy of the dataset RNG from the worker
+# seed. The worker seeds are drawn from torch's RNG for each epoch, so the
+# augmentations are reproducible with torch.manual_seed and differ between
+# epochs.
+def seed_dataset_worker(worker_id):
+    worker_info = torch.utils.data.get_worker_info()
+    rng = dataset_rng(worker_info.dataset)
+    if rng is not None:
+        rng.seed(worker_info.seed)
+
+# The augmentation RNG of a dataset, also through (nested) Subsets; None for
+# datasets without one
+def dataset_rng(dataset):
+    while isinstance(dataset, torch.utils.data.Subset):
+        dataset = dataset.dataset
+    return getattr(dataset, 'rng', None)
+
+# The uint8 background tensors, composited a batch at a time by
+# RandomPasteBatchCollate
+class BackgroundTensorDataset(Dataset):
+    def __init__(self, background_images):
+        self.background_images = background_images
+
+    def __getitem__(self, idx):
+        return torch.from_numpy(np.asarray(self.background_images[idx])).permute(2, 0, 1)
+
+    def __len__(self):
+        return len(self.background_images)
+
+# collate_fn that pastes the turtle onto a batch of backgrounds with
+# random_paste_batch on the given device. It uses CUDA, so the loader must
+# run it in the main process (num_workers=0).
+class RandomPasteBatchCollate:
+    def __init__(self, turtle_image, device, seed=42):
+        self.turtle_template = tensor_transform(turtle_image).to(device)
+        self.device = device
+        self.generator = torch.Generator().manual_seed(seed)
+
+    def __call__(self, backgrounds):
+        images, masks = random_paste_batch(torch.stack(backgrounds).to(self.device, non_blocking=True),
+                                           self.turtle_template, generator=self.generator)
+        return images, masks.float()
+
 ## NOTE: This section can be skipped to save time - Only used for training
 
-train_dataset = TurtleDataset(training_set)
+train_dataset = RandomPasteTurtleDataset(background_images, turtle_image_256x256)
 
-train_loader = DataLoader(train_dataset, batch_size=16, shuffle=True, num_workers=8)
+if device.type == "cuda":
+    # only the uint8 backgrounds are read from the shards, the compositing
+    # runs batched on the GPU
+    train_loader = DataLoader(BackgroundTensorDataset(background_images), batch_size=16, shuffle=True,
+                              collate_fn=RandomPasteBatchCollate(turtle_image_256x256, device))
+else:
+    train_loader = DataLoader(train_dataset, batch_size=16, shuffle=True, num_workers=8,
+                              worker_init_fn=seed_dataset_worker)
 
 # U-Net Model
 
@@ -333,6 +749,79 @@ class UNet(Module):
 
 unet = UNet().to(device)
 
+# Checkpoints
+#
+# torch.save(unet, ...) pickles the whole module, so loading it depends on the
+# class definitions and the torch version it was saved with (which is why
+# checkpoint36.pth fails to load after downloading it with gdown). The format
+# below stores only the state_dict plus a small header with the format
+# version, epoch, loss and architecture. It loads with weights_only=True and
+# mmap=True, so the weights are mapped from the file instead of being copied.
+
+import functools
+import glob
+import re
+
+checkpoint_format_version = 1
+unet_architectures = {'UNet': UNet}
+
+def save_unet_checkpoint(model, path, epoch=None, loss=None):
+  torch.save({
+      'format_version': checkpoint_format_version,
+      'epoch': epoch,
+      'loss': loss,
+      'arch': {'name': type(model).__name__, 'config': {}},
+      'state_dict': model.state_dict(),
+  }, path)
+
+# Returns the model (in eval mode) and the checkpoint header
+def load_unet_checkpoint(path, map_location=None):
+  checkpoint = torch.load(path, map_location='cpu', mmap=True, weights_only=True)
+  if checkpoint.get('format_version') != checkpoint_format_version:
+    raise ValueError("{} is not a version {} checkpoint".format(path, checkpoint_format_version))
+  arch = checkpoint['arch']
+  model = unet_architectures[arch['name']](**arch['config'])
+  # assign keeps the memory-mapped tensors instead of copying them
+  model.load_state_dict(checkpoint.pop('state_dict'), assign=True)
+  return model.to(device if map_location is None else map_location).eval(), checkpoint
+
+# Converts a checkpoint pickled with torch.save(unet, ...). The epoch is taken
+# from the file name, the loss wasn't saved.
+def convert_pickled_checkpoint(src_path, dst_path):
+  model = torch.load(src_path, map_location='cpu', weights_only=False)
+  match = re.search(r'checkpoint(\d+)', os.path.basename(src_path))
+  save_unet_checkpoint(model, dst_path, epoch=int(match.group(1)) if match else None)
+
+# Converts every checkpoint*.pth in src_dir to checkpoint*.pt in dst_dir,
+# skipping the ones that were already converted
+def convert_checkpoint_directory(src_dir, dst_dir):
+  os.makedirs(dst_dir, exist_ok=True)
+  for src_path in sorted(glob.glob(os.path.join(src_dir, 'checkpoint*.pth'))):
+    dst_path = os.path.join(dst_dir, os.path.basename(src_path)[:-len('.pth')] + '.pt')
+    if not os.path.exists(dst_path):
+      convert_pickled_checkpoint(src_path, dst_path)
+
+# LRU cache of loaded models, so checkpoint sweeps and repeated inference don't
+# deserialize the same weights again. A file that changed on disk gets a new
+# cache entry through its modification time. The cached models are shared, so
+# they must not be trained or modified in place.
+#
+# A sweep that cycles through more checkpoints than the cache holds evicts
+# every entry before it is used again, so the default holds the whole 40
+# checkpoint sweep (the weights are about 0.5 MB per model and memory-mapped).
+# Set checkpoint_cache_size and re-run this cell to change it.
+checkpoint_cache_size = 40
+
+def load_unet_checkpoint_for_cache(path, modified_time, device_name):
+  return load_unet_checkpoint(path, torch.device(device_name))
+
+load_cached_unet_checkpoint = functools.lru_cache(maxsize=checkpoint_cache_size)(load_unet_checkpoint_for_cache)
+
+def get_unet(path, map_location=None):
+  path = os.path.abspath(path)
+  map_location = device if map_location is None else map_location
+  return load_cached_unet_checkpoint(path, os.path.getmtime(path), str(map_location))[0]
+
 ## NOTE: Mentioned about this section later during inference
 
 from google.colab import drive
@@ -347,25 +836,199 @@ num_epochs = 40
 # TODO: Implement and train the deep model
 
 from tqdm import tqdm
-
-lossFunc = BCEWithLogitsLoss()
-opt = Adam(unet.parameters(), lr=1e-4)
-
-for epoch in tqdm(range(num_epochs)):
-  unet.train()
-  train_loss = 0
-  for idx, (x, y) in enumerate(train_loader):
-    (x, y) = (x.to(device), y.to(device))
-    pred = unet(x)
-    loss = lossFunc(pred, y)
-    opt.zero_grad()
-    loss.backward()
-    opt.step()
-    train_loss += loss
-  train_loss /= len(train_loader)
-  print("EPOCH: {}\tLOSS: {:.6f}".format(epoch + 1, train_loss))
+import torch.distributed as dist
+
+# Trains the model and returns the loss and duration of every epoch.
+#   amp_dtype: None for fp32, or torch.bfloat16 / torch.float16 to run the
+#     forward pass under autocast (float16 uses a gradient scaler)
+#   channels_last: keep the model and the inputs in channels_last memory format
+#   compile_model: run the forward pass through torch.compile
+#   accumulation_steps: number of batches whose gradients are accumulated
+#     before each optimizer step
+#   save_checkpoint: called as save_checkpoint(model, epoch, loss) every
+#     checkpoint_every epochs and after the last epoch
+# The loss is accumulated detached on the device, so no autograd history is
+# kept alive and the device is only synchronized once per epoch.
+def train_unet(model, loader, num_epochs, lr=1e-4, amp_dtype=None, channels_last=False, compile_model=False,
+               accumulation_steps=1, save_checkpoint=None, checkpoint_every=1, verbose=True, device=device):
+  lossFunc = BCEWithLogitsLoss()
+  opt = Adam(model.parameters(), lr=lr)
+  scaler = torch.amp.GradScaler(device.type, enabled=amp_dtype == torch.float16)
+  if channels_last:
+    model = model.to(memory_format=torch.channels_last)
+  forward = torch.compile(model) if compile_model else model
+  history = []
+
+  for epoch in tqdm(range(num_epochs), disable=not verbose):
+    start = time.perf_counter()
+    model.train()
+    # a DistributedSampler shuffles differently in every epoch
+    if hasattr(getattr(loader, 'sampler', None), 'set_epoch'):
+      loader.sampler.set_epoch(epoch)
+    train_loss = torch.zeros((), device=device)
+    opt.zero_grad(set_to_none=True)
+    for idx, (x, y) in enumerate(loader):
+      (x, y) = (x.to(device, non_blocking=True), y.to(device, non_blocking=True))
+      if channels_last:
+        x = x.contiguous(memory_format=torch.channels_last)
+      with torch.autocast(device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+        pred = forward(x, tuple(y.shape[-2:]))
+      loss = lossFunc(pred.float(), y)
+      scaler.scale(loss / accumulation_steps).backward()
+      if (idx + 1) % accumulation_steps == 0 or idx + 1 == len(loader):
+        scaler.step(opt)
+        scaler.update()
+        opt.zero_grad(set_to_none=True)
+      train_loss += loss.detach()
+    train_loss = train_loss / len(loader)
+    if dist.is_available() and dist.is_initialized():
+      dist.all_reduce(train_loss)
+      train_loss /= dist.get_world_size()
+    train_loss = train_loss.item()
+    history.append({'epoch': epoch, 'loss': train_loss, 'seconds': time.perf_counter() - start})
+    if verbose:
+      print("EPOCH: {}\tLOSS: {:.6f}".format(epoch + 1, train_loss))
+    if save_checkpoint is not None and ((epoch + 1) % checkpoint_every == 0 or epoch + 1 == num_epochs):
+      save_checkpoint(model, epoch, train_loss)
+  return history
+
+def save_drive_checkpoint(model, epoch, loss):
   # TODO: Save the model weights and upload them to Google Drive
-  torch.save(unet, f'{model_save_location}/checkpoint{epoch}.pth')
+  save_unet_checkpoint(model, f'{model_save_location}/checkpoint{epoch}.pt', epoch, loss)
+
+train_unet(unet, train_loader, num_epochs, save_checkpoint=save_drive_checkpoint)
+
+## NOTE: Only used for benchmarking. This section can be skipped.
+
+# Step time and samples/s of every training option on synthetic batches. The
+# first epoch is a warm-up (torch.compile compiles the model there) and only
+# the second one is measured.
+def benchmark_training_options(batch_size=8, resolution=256, num_batches=4):
+  batches = [(torch.rand(batch_size, 3, resolution, resolution), (torch.rand(batch_size, 1, resolution, resolution) > 0.5).float())
+             for _ in range(num_batches)]
+  options = {
+      'fp32': {},
+      'bfloat16 autocast': {'amp_dtype': torch.bfloat16},
+      'channels_last': {'channels_last': True},
+      'torch.compile': {'compile_model': True},
+      'accumulation x2': {'accumulation_steps': 2},
+  }
+  if device.type == "cuda":
+    options['float16 autocast'] = {'amp_dtype': torch.float16}
+  for name, kwargs in options.items():
+    torch.manual_seed(0)
+    model = UNet().to(device)
+    history = train_unet(model, batches, 2, verbose=False, **kwargs)
+    step_time = history[-1]['seconds'] / num_batches
+    print("{}: {:.3f}s/step, {:.1f} samples/s".format(name, step_time, batch_size / step_time))
+
+benchmark_training_options()
+
+## NOTE: This section can be skipped to save time - Only used for training
+
+# Distributed data parallel training with the gloo backend, so it also runs
+# as several CPU processes on one machine. Every process trains a replica of
+# the model on its shard of the dataset (DistributedSampler) and DDP averages
+# the gradients. Only rank 0 prints metrics and saves checkpoints. For several
+# machines, run the same call on every node with its node_rank and the address
+# of node 0 as master_addr.
+
+import queue
+import socket
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data.distributed import DistributedSampler
+
+def find_free_port():
+  with socket.socket() as sock:
+    sock.bind(('', 0))
+    return sock.getsockname()[1]
+
+def ddp_train_worker(local_rank, model, dataset, num_epochs, batch_size, num_workers, nprocs, node_rank, num_nodes,
+                     master_addr, master_port, save_checkpoint, result_queue, seed, train_kwargs):
+  rank = node_rank * nprocs + local_rank
+  world_size = num_nodes * nprocs
+  os.environ['MASTER_ADDR'] = master_addr
+  os.environ['MASTER_PORT'] = str(master_port)
+  dist.init_process_group('gloo', rank=rank, world_size=world_size)
+  # split the cores of the machine between the processes
+  torch.set_num_threads(max(1, os.cpu_count() // nprocs))
+  torch.manual_seed(seed + rank)
+  # the forked ranks all inherit the same dataset RNG; without workers it is
+  # used directly, so it must differ between the ranks too
+  rng = dataset_rng(dataset)
+  if rng is not None:
+    rng.seed(seed + rank)
+  try:
+    # gloo trains on the CPU, and CUDA can't be used in a forked child once
+    # the parent has initialised it
+    ddp_model = DistributedDataParallel(model.cpu())
+    sampler = DistributedSampler(dataset, num_replicas=world_size, rank=rank, shuffle=True, seed=seed)
+    loader = DataLoader(dataset, batch_size=batch_size, sampler=sampler, num_workers=num_workers,
+                        worker_init_fn=seed_dataset_worker if num_workers > 0 else None)
+    checkpoint = None
+    if rank == 0 and save_checkpoint is not None:
+      checkpoint = lambda ddp_model, epoch, loss: save_checkpoint(ddp_model.module, epoch, loss)
+    train_kwargs = dict(train_kwargs)
+    verbose = train_kwargs.pop('verbose', True) and rank == 0
+    history = train_unet(ddp_model, loader, num_epochs, save_checkpoint=checkpoint, verbose=verbose,
+                         device=torch.device('cpu'), **train_kwargs)
+    if rank == 0:
+      # numpy arrays, so nothing refers to this process' shared memory once it exits
+      result_queue.put((history, {k: v.cpu().numpy() for k, v in model.state_dict().items()}))
+  finally:
+    dist.destroy_process_group()
+
+# Trains model with nprocs processes on this node and loads the trained
+# weights back into model. Returns the per-epoch history of rank 0 (the loss
+# is averaged over all processes). Training runs on the CPU, so a model on
+# the GPU is moved to the CPU first and stays there.
+def train_unet_distributed(model, dataset, num_epochs, nprocs=2, batch_size=16, num_workers=0, node_rank=0,
+                           num_nodes=1, master_addr='127.0.0.1', master_port=None, save_checkpoint=None, seed=42,
+                           **train_kwargs):
+  # the forked ranks must not touch CUDA
+  model.cpu()
+  master_port = find_free_port() if master_port is None else master_port
+  # fork, so the functions and the dataset defined in the notebook don't have
+  # to be picklable
+  result_queue = mp.get_context('fork').Queue()
+  context = mp.start_processes(
+      ddp_train_worker,
+      args=(model, dataset, num_epochs, batch_size, num_workers, nprocs, node_rank, num_nodes, master_addr,
+            master_port, save_checkpoint, result_queue, seed, train_kwargs),
+      nprocs=nprocs, join=False, start_method='fork')
+  history = None
+  while node_rank == 0 and history is None:
+    try:
+      history, state_dict = result_queue.get(timeout=1)
+    except queue.Empty:
+      # join raises if one of the processes failed
+      if context.join(timeout=0):
+        raise RuntimeError("The training processes exited without a result")
+      continue
+    model.load_state_dict({k: torch.from_numpy(v) for k, v in state_dict.items()})
+  while not context.join():
+    pass
+  return history
+
+## NOTE: Only used for benchmarking. This section can be skipped.
+
+# Samples/s of one epoch with an increasing number of processes on this
+# machine. The dataset and the per-process batch size stay fixed, so with
+# linear scaling the epoch time drops by the number of processes.
+def benchmark_ddp_scaling(dataset, process_counts=(1, 2, 4), batch_size=8, num_epochs=2):
+  baseline = None
+  for nprocs in process_counts:
+    torch.manual_seed(0)
+    history = train_unet_distributed(UNet(), dataset, num_epochs, nprocs=nprocs, batch_size=batch_size, verbose=False)
+    # the first epoch is a warm-up
+    samples_per_sec = len(dataset) / history[-1]['seconds']
+    baseline = samples_per_sec if baseline is None else baseline
+    speedup = samples_per_sec / baseline
+    print("{} processes: {:.1f} samples/s, speedup {:.2f}x, efficiency {:.0%}".format(
+        nprocs, samples_per_sec, speedup, speedup / nprocs))
+
+benchmark_ddp_scaling(torch.utils.data.Subset(train_dataset, range(256)))
 
 ## PLEASE NOTE:
     #
@@ -414,9 +1077,12 @@ if load_model_weights:
     # checkpoint (checkpoint36.pth) from saved_model_public_link
     # i.e. 'https://drive.google.com/drive/u/0/folders/14p-cYoHsxcWcce4gMPIUFGlvuZi1e3nj'
     # and upload to your own google drive.
-    # Finally use the below line with your g drive link to load
-    unet = torch.load(model_save_location + '/checkpoint36.pth')
-    unet.eval()
+    #
+    # The pickled checkpoints (including the ones in Checkpoints/) only need
+    # to be converted once; the converted state_dict checkpoints load with any
+    # torch version
+    convert_checkpoint_directory(model_save_location, model_save_location)
+    unet = get_unet(model_save_location + '/checkpoint36.pt')
 
 test_image_tensor = tensor_transform(test_image)
 
@@ -435,17 +1101,351 @@ plt.imshow(test_image_tensor.numpy().transpose(1, 2, 0))
 plt.subplot(122)
 plt.imshow(test_mask_tensor[:, :, None].numpy(), cmap="gray", vmin=0, vmax=1)
 
+# get_mask_from_image pushes one image at a time through the model and keeps
+# the autograd state of every forward pass. Below is a batched inference path:
+# images of the same size are grouped into batches and run under
+# torch.inference_mode. Images larger than tile_size are split into tiles, so
+# memory stays bounded for very large inputs.
+#
+# The UNet convolutions are unpadded, so the model output is 40 pixels smaller
+# than its input and output pixel i shows input pixel i + 20; UNet.forward then
+# stretches it to outSize. Stitching stretched tiles would put every tile
+# pixel at the wrong image position. Instead, the tiled path pads the image
+# with 20 pixels of context, runs every tile together with its context and
+# keeps the native model output, which covers exactly the tile. Tiles start at
+# multiples of the encoder stride, so their pooling grids line up with the
+# full image and the tiles reproduce predict_logits_padded, the same
+# computation on the whole image at once.
+
+unet_context = 20 # pixels lost on every side by the unpadded convolutions
+unet_stride = 4 # downsampling of the encoder
+
+image_extensions = ('.png', '.jpg', '.jpeg', '.bmp')
+
+# Yields (key, image tensor) pairs from a directory or from an iterable of
+# PIL images / 3xHxW tensors. The key is the file path or the index.
+def iterate_images(images):
+  if isinstance(images, str):
+    names = sorted(name for name in os.listdir(images) if name.lower().endswith(image_extensions))
+    for name in names:
+      path = os.path.join(images, name)
+      with Image.open(path) as image:
+        yield path, tensor_transform(image.convert('RGB'))
+  else:
+    for idx, image in enumerate(images):
+      if isinstance(image, Image.Image):
+        image = tensor_transform(image.convert('RGB'))
+      yield idx, image
+
+def tile_starts(size, tile_size, stride):
+  if size <= tile_size:
+    return [0]
+  starts = list(range(0, size - tile_size, stride))
+  return starts + [size - tile_size]
+
+def round_up(size, multiple):
+  return (size + multiple - 1) // multiple * multiple
+
+# Pads a 3xHxW image with the model context on every side, plus up to
+# unet_stride - 1 pixels at the bottom and right so the output size is a
+# multiple of the stride. Returns the 1x3xH'xW' padded image and the output
+# size.
+def pad_with_context(image):
+  _, h, w = image.shape
+  out_h, out_w = round_up(h, unet_stride), round_up(w, unet_stride)
+  padding = (unet_context, unet_context + out_w - w, unet_context, unet_context + out_h - h)
+  return F.pad(image[None], padding, mode='replicate'), (out_h, out_w)
+
+# Logits of the whole image in one pass, without stretching the model output
+def predict_logits_padded(model, image):
+  _, h, w = image.shape
+  padded, out_size = pad_with_context(image)
+  # the native output already has out_size, so forward doesn't resize it
+  return model(padded, out_size)[0, 0, :h, :w]
+
+# Runs the out_h x out_w output tiles starting at corners (in output
+# coordinates) and writes their logits into logits. padded comes from
+# pad_with_context.
+def predict_tiles(model, padded, corners, tile_h, tile_w, batch_size, logits):
+  for batch_start in range(0, len(corners), batch_size):
+    batch_corners = corners[batch_start:batch_start + batch_size]
+    tiles = torch.stack([padded[0, :, y:y + tile_h + 2 * unet_context, x:x + tile_w + 2 * unet_context]
+                         for y, x in batch_corners])
+    tile_logits = model(tiles, (tile_h, tile_w))[:, 0]
+    for (y, x), tile_logit in zip(batch_corners, tile_logits):
+      logits[y:y + tile_h, x:x + tile_w] = tile_logit
+
+def tile_corners(out_size, tile_size):
+  # tile_size is rounded down to a multiple of the stride, so that every tile
+  # starts on the pooling grid of the full image
+  tile_size = max(tile_size // unet_stride * unet_stride, unet_stride)
+  tile_h, tile_w = min(tile_size, out_size[0]), min(tile_size, out_size[1])
+  corners = [(y, x) for y in tile_starts(out_size[0], tile_h, tile_h) for x in tile_starts(out_size[1], tile_w, tile_w)]
+  return corners, tile_h, tile_w
+
+def predict_logits_tiled(model, image, tile_size, batch_size):
+  _, h, w = image.shape
+  padded, out_size = pad_with_context(image)
+  corners, tile_h, tile_w = tile_corners(out_size, tile_size)
+  logits = torch.zeros(out_size, device=image.device)
+  predict_tiles(model, padded, corners, tile_h, tile_w, batch_size, logits)
+  return logits[:h, :w]
+
+# Current and peak resident memory of the process in MB, from
+# /proc/self/status (Linux). The peak can be reset with reset_peak_rss, so it
+# covers only the code that runs after the reset.
+def read_rss_mb():
+  values = {}
+  with open('/proc/self/status') as f:
+    for line in f:
+      if line.startswith(('VmRSS:', 'VmHWM:')):
+        name, value = line.split(':')
+        values[name] = int(value.split()[0]) / 2 ** 10
+  return values['VmRSS'], values['VmHWM']
+
+def reset_peak_rss():
+  try:
+    with open('/proc/self/clear_refs', 'w') as f:
+      f.write('5')
+    return True
+  except OSError:
+    return False
+
+# Yields (key, mask) pairs, where the masks are thresholded exactly like
+# get_mask_from_image. Masks come out grouped by image size, so their order
+# can differ from the input order. Images larger than tile_size are run in
+# tiles and give the masks of predict_logits_padded. With row_runs=True the
+# masks are RowRunMask objects extracted on the device instead of dense byte
+# masks. If a stats dict is given, it is filled with the number of images,
+# images/sec and the peak memory of the inference.
+def predict_masks(images, model=None, batch_size=8, tile_size=None, stats=None, row_runs=False):
+  model = unet if model is None else model
+  model.eval()
+  if device.type == "cuda":
+    torch.cuda.reset_peak_memory_stats()
+  elif stats is not None:
+    # the process peak would otherwise include BigGAN and training; without
+    # a reset the peak is sampled after every batch instead
+    peak_reset = reset_peak_rss()
+    peak_rss_mb = read_rss_mb()[0]
+  start = time.perf_counter()
+  num_images = 0
+  # images waiting to be batched, by size
+  pending = {}
+
+  def sample_memory():
+    nonlocal peak_rss_mb
+    if device.type != "cuda" and stats is not None:
+      peak_rss_mb = max(peak_rss_mb, read_rss_mb()[0])
+
+  def flush(size):
+    keys, batch = zip(*pending.pop(size))
+    logits = model(torch.stack(batch).to(device), size)[:, 0]
+    sample_memory()
+    if row_runs:
+      return zip(keys, map(RowRunMask.from_logits, logits))
+    return zip(keys, (logits > 0.5).byte().cpu())
+
+  with torch.inference_mode():
+    for key, image in iterate_images(images):
+      num_images += 1
+      size = tuple(image.shape[-2:])
+      if tile_size is not None and max(size) > tile_size:
+        logits = predict_logits_tiled(model, image.to(device), tile_size, batch_size)
+        sample_memory()
+        yield key, RowRunMask.from_logits(logits) if row_runs else (logits > 0.5).byte().cpu()
+        continue
+      pending.setdefault(size, []).append((key, image))
+      if len(pending[size]) == batch_size:
+        yield from flush(size)
+    for size in list(pending):
+      yield from flush(size)
+
+  if stats is not None:
+    elapsed = time.perf_counter() - start
+    stats['images'] = num_images
+    stats['images_per_sec'] = num_images / elapsed if elapsed > 0 else 0.0
+    if device.type == "cuda":
+      stats['peak_memory_mb'] = torch.cuda.max_memory_allocated() / 2 ** 20
+    else:
+      stats['peak_memory_mb'] = read_rss_mb()[1] if peak_reset else peak_rss_mb
+
+## NOTE: Only used for verification. This section can be skipped.
+
+# The batched path must give the same masks as the single image path
+batch_stats = {}
+check_images = [test_image_tensor, test_image_tensor.flip(-1), test_image_tensor.flip(-2)]
+for key, mask in predict_masks(check_images, batch_size=2, stats=batch_stats):
+  with torch.inference_mode():
+    assert torch.equal(mask, get_mask_from_image(check_images[key]).cpu())
+print("{images} images, {images_per_sec:.2f} images/s, peak memory {peak_memory_mb:.0f} MB".format(**batch_stats))
+
+# The tiled path must give the same masks as the full image, also for sizes
+# that are not multiples of the tile size or the stride. The tiles and the full
+# image may use different convolution algorithms, so the logits only agree up
+# to rounding and pixels right at the threshold can flip.
+for check_image in [test_image_tensor, test_image_tensor[:, :301, :457]]:
+  with torch.inference_mode():
+    full_logits = predict_logits_padded(unet, check_image.to(device))
+    tiled_logits = predict_logits_tiled(unet, check_image.to(device), tile_size=128, batch_size=4)
+  assert torch.allclose(tiled_logits, full_logits, atol=1e-4)
+  tiled_mask = dict(predict_masks([check_image], tile_size=128, batch_size=4))[0]
+  at_threshold = ((full_logits - 0.5).abs() < 1e-4).cpu()
+  assert not ((tiled_mask != (full_logits > 0.5).byte().cpu()) & ~at_threshold).any()
+
 ## NOTE: Only used for experimentation. This section can be skipped.
 
 mask_img = []
 for i in range(40):
-  unet = torch.load(model_save_location + f"/checkpoint{i}.pth")
-  unet.eval()
+  unet = get_unet(model_save_location + f"/checkpoint{i}.pt")
   mask_img.append(get_mask_from_image(test_image_tensor).cpu()[None, :, :])
 
 plt.figure(figsize=(20, 20))
 plt.imshow(torchvision.utils.make_grid(mask_img, nrow=8).permute(1, 2, 0).numpy()*255)
 
+## NOTE: Only used for deployment. This section can be skipped.
+
+# Exported inference artifact
+#
+# Running inference with the notebook requires importing matplotlib, gdown
+# and pytorch_pretrained_biggan, defining the UNet classes and unpickling the
+# full module. Instead, the model can be exported as a frozen TorchScript
+# module for a fixed input size: every conv1 + ReLU pair is fused, the
+# CenterCrop offsets of the skip connections are computed once at export and
+# baked in as plain slices, and the output size of F.interpolate is fixed. The
+# artifact is loaded by turtle_inference.py, which only imports torch.
+
+import copy
+import subprocess
+import sys
+from torch.ao.quantization import fuse_modules
+
+class FusedUNet(Module):
+  def __init__(self, unet, input_size=(512, 512), output_size=(512, 512), fuse=True):
+    super().__init__()
+    unet = copy.deepcopy(unet).cpu().eval()
+    if fuse:
+      for conv_module in list(unet.encoder.encoding_modules) + list(unet.decoder.decoding_modules):
+        fuse_modules(conv_module, [['conv1', 'relu']], inplace=True)
+    self.encoding_modules = unet.encoder.encoding_modules
+    self.maxpool = unet.encoder.maxpool
+    self.upsampling_modules = unet.decoder.upsampling_modules
+    self.decoding_modules = unet.decoder.decoding_modules
+    self.final_layer = unet.final_layer
+    self.output_size = output_size
+    self.crops = self.compute_crops(input_size)
+
+  # (top, left, height, width) of every skip connection, same as CenterCrop
+  def compute_crops(self, input_size):
+    crops = []
+    with torch.no_grad():
+      features = self.encode(torch.zeros(1, 3, *input_size))
+      x = features[-1]
+      for idx, upsampling_module in enumerate(self.upsampling_modules):
+        x = upsampling_module(x)
+        f = features[-2 - idx]
+        h, w = x.shape[-2:]
+        crops.append((int(round((f.shape[-2] - h) / 2.0)), int(round((f.shape[-1] - w) / 2.0)), h, w))
+        x = self.decoding_modules[idx](torch.cat([x, f[:, :, :h, :w]], dim=1))
+    return crops
+
+  def encode(self, x):
+    features = []
+    for module in self.encoding_modules:
+      x = module(x)
+      features.append(x)
+      x = self.maxpool(x)
+    return features
+
+  def forward(self, x):
+    features = self.encode(x)
+    x = features[-1]
+    for idx, upsampling_module in enumerate(self.upsampling_modules):
+      x = upsampling_module(x)
+      top, left, h, w = self.crops[idx]
+      x = torch.cat([x, features[-2 - idx][:, :, top:top + h, left:left + w]], dim=1)
+      x = self.decoding_modules[idx](x)
+    # without an output size the logits keep the size of the last feature map
+    if self.output_size is None:
+      return self.final_layer(x)
+    return F.interpolate(self.final_layer(x), self.output_size)
+
+def export_unet_torchscript(model, path, input_size=(512, 512)):
+  fused = FusedUNet(model, input_size, input_size).eval()
+  with torch.no_grad():
+    traced = torch.jit.trace(fused, torch.zeros(1, 3, *input_size))
+  frozen = torch.jit.freeze(traced)
+  frozen.save(path)
+  return frozen
+
+# ONNX export of the same fused graph, needs the onnx package
+def export_unet_onnx(model, path, input_size=(512, 512)):
+  fused = FusedUNet(model, input_size, input_size).eval()
+  torch.onnx.export(fused, torch.zeros(1, 3, *input_size), path, input_names=['image'], output_names=['logits'],
+                    dynamic_axes={'image': {0: 'batch'}, 'logits': {0: 'batch'}})
+
+# Seconds until a fresh Python process has a model loaded and has predicted
+# one mask with the exported artifact. For the notebook path, the imports are
+# timed in a fresh process, and unpickling the full module plus the first
+# prediction are timed here, where the UNet classes are defined.
+# turtle_inference.py is imported from module_dir (the repository checkout).
+# Returns None if it isn't there, e.g. in a fresh Colab runtime.
+def measure_cold_start(artifact_path, pickled_checkpoint_path, input_size=(512, 512), module_dir='.'):
+  if not os.path.exists(os.path.join(module_dir, 'turtle_inference.py')):
+    print("Skipping the cold start measurement: turtle_inference.py is not in {}".format(os.path.abspath(module_dir)))
+    return None
+  h, w = input_size
+  slim_code = """
+import time
+start = time.perf_counter()
+import sys
+sys.path.insert(0, {module_dir!r})
+import torch, turtle_inference
+model = turtle_inference.load_segmenter({artifact!r})
+turtle_inference.predict_mask(model, torch.rand(3, {h}, {w}))
+print(time.perf_counter() - start)
+""".format(module_dir=os.path.abspath(module_dir), artifact=os.path.abspath(artifact_path), h=h, w=w)
+  imports_code = """
+import time
+start = time.perf_counter()
+import matplotlib.pyplot, gdown, pytorch_pretrained_biggan, torch, torchvision
+print(time.perf_counter() - start)
+"""
+  def run(code):
+    output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True)
+    return float(output.stdout.strip().splitlines()[-1])
+
+  start = time.perf_counter()
+  model = torch.load(pickled_checkpoint_path, map_location='cpu', weights_only=False).eval()
+  with torch.inference_mode():
+    model(torch.rand(1, 3, h, w), (h, w))
+  notebook_load = time.perf_counter() - start
+  return {'exported': run(slim_code), 'notebook': run(imports_code) + notebook_load}
+
+def measure_latency(model, image, num_runs=20):
+  with torch.inference_mode():
+    model(image)
+    start = time.perf_counter()
+    for _ in range(num_runs):
+      model(image)
+  return (time.perf_counter() - start) / num_runs
+
+unet = get_unet(model_save_location + '/checkpoint36.pt', 'cpu')
+exported_unet = export_unet_torchscript(unet, 'turtle_unet_512.pt')
+
+# the exported model predicts the same masks
+with torch.inference_mode():
+  exported_mask = (exported_unet(test_image_tensor[None]) > 0.5)[0, 0]
+  assert torch.equal(exported_mask, unet(test_image_tensor[None], (512, 512))[0, 0] > 0.5)
+
+cold_start = measure_cold_start('turtle_unet_512.pt', model_save_location + '/checkpoint36.pth')
+if cold_start is not None:
+  print("cold start (s):", cold_start)
+print("latency per image, eager: {:.1f} ms, exported: {:.1f} ms".format(
+    measure_latency(lambda x: unet(x, (512, 512)), test_image_tensor[None]) * 1000,
+    measure_latency(exported_unet, test_image_tensor[None]) * 1000))
+unet = get_unet(model_save_location + '/checkpoint36.pt')
+
 """# Task 2: Calculating tight enclosing polygon from segmentation mask
 
 *This is where you need to implement your algorithm that predicts a convex hull, an enclosing polygon of foreground pixels. You are not allowed to use cv2, scikit-image or other libraries' functionality that readily solve this task. Treat this problem as point-based rather than the image-based one.*
@@ -500,7 +1500,220 @@ def visualize_polygon_on_image(test_image, polygon_points_n2):
   plt.imshow(test_image.numpy().transpose(1, 2, 0))
   plt.plot(xs.numpy(), ys.numpy())
 
-polygon_points_n2_tensor = get_tight_polygon_from_mask(test_mask_tensor)
+# Gift wrapping indexes the points tensor once per (hull vertex x foreground
+# pixel) pair, which takes seconds on a 512x512 mask. Below is Andrew's
+# monotone chain algorithm that runs in O(n log n) time, with the sort and the
+# candidate reduction done in NumPy.
+#
+# Points are (row, col) pairs as returned by torch.where. The output starts at
+# the same left-most vertex and walks in the same direction as
+# get_tight_polygon_from_mask. Collinear points on the hull edges are always
+# dropped (gift wrapping keeps some of them depending on the pixel order);
+# they don't change the polygon or its area.
+
+def cross_product(o, a, b):
+  return (a[1] - o[1]) * (b[0] - o[0]) - (a[0] - o[0]) * (b[1] - o[1])
+
+def convex_hull_monotone_chain(points_n2):
+  points_n2 = np.asarray(points_n2, dtype=np.int64).reshape(-1, 2)
+  if points_n2.shape[0] == 0:
+    return points_n2
+
+  # Sort by column, then by row. Only the top-most and bottom-most point of
+  # each column can be a hull vertex, so every other point is discarded here.
+  order = np.lexsort((points_n2[:, 0], points_n2[:, 1]))
+  points_n2 = points_n2[order]
+  cols = points_n2[:, 1]
+  first = np.flatnonzero(np.r_[True, cols[1:] != cols[:-1]])
+  last = np.r_[first[1:] - 1, points_n2.shape[0] - 1]
+  keep = np.unique(np.concatenate([first, last]))
+  points = [tuple(p) for p in points_n2[keep].tolist()]
+  if len(points) < 3:
+    return np.array(points, dtype=np.int64).reshape(-1, 2)
+
+  # Build the lower (small row) and upper (large row) chains, popping every
+  # point that doesn't make a strict turn
+  lower = []
+  for p in points:
+    while len(lower) >= 2 and cross_product(lower[-2], lower[-1], p) <= 0:
+      lower.pop()
+    lower.append(p)
+  upper = []
+  for p in reversed(points):
+    while len(upper) >= 2 and cross_product(upper[-2], upper[-1], p) <= 0:
+      upper.pop()
+    upper.append(p)
+
+  # The last point of each chain is the first point of the other one
+  return np.array(lower[:-1] + upper[:-1], dtype=np.int64)
+
+# Only the left-most and right-most foreground pixel of a row can be a vertex
+# of the convex hull, so the mask is reduced to at most 2 x H candidate points
+# before any hull algorithm runs. This avoids materializing the N x 2 index
+# tensor of all foreground pixels, and the hull cost depends on the image
+# height rather than the turtle area. Points are returned in row-major order,
+# just like torch.where. The mask is processed chunk_rows rows at a time, so
+# the temporaries stay small for very large masks.
+def boundary_points_from_mask(test_mask, chunk_rows=256):
+  width = test_mask.shape[1]
+  cols = torch.arange(width, device=test_mask.device, dtype=torch.int16 if width < 2 ** 15 else torch.int32)
+  points = []
+  for row_start in range(0, test_mask.shape[0], chunk_rows):
+    foreground = (test_mask[row_start:row_start + chunk_rows] == 1).to(torch.uint8)
+    rows = torch.where(foreground.any(1))[0]
+    # argmax returns the index of the first maximal value, and the largest
+    # foreground column index is the right edge
+    left = foreground.argmax(1)[rows]
+    right = (foreground * cols).amax(1)[rows].long()
+    rows = rows + row_start
+    points_k22 = torch.stack([torch.stack([rows, left], 1), torch.stack([rows, right], 1)], 1)
+    # single pixel rows only contribute one point
+    keep_k2 = torch.ones(rows.shape[0], 2, dtype=torch.bool, device=rows.device)
+    keep_k2[:, 1] = right != left
+    points.append(points_k22[keep_k2])
+  if not points:
+    return torch.zeros(0, 2, dtype=torch.int64, device=test_mask.device)
+  return torch.cat(points)
+
+# Same as boundary_points_from_mask for a mask given as row runs, i.e. the
+# foreground pixels of run i are test_mask[rows[i], starts[i]:stops[i]]. A row
+# may contain any number of runs, in any order.
+def boundary_points_from_row_runs(rows, starts, stops):
+  rows, starts, stops = (np.asarray(a, dtype=np.int64) for a in (rows, starts, stops))
+  if rows.shape[0] == 0:
+    return torch.zeros(0, 2, dtype=torch.int64)
+  order = np.argsort(rows, kind='stable')
+  rows, starts, stops = rows[order], starts[order], stops[order]
+  first = np.flatnonzero(np.r_[True, rows[1:] != rows[:-1]])
+  left = np.minimum.reduceat(starts, first)
+  right = np.maximum.reduceat(stops - 1, first)
+  points_k22 = np.stack([np.stack([rows[first], left], 1), np.stack([rows[first], right], 1)], 1)
+  keep_k2 = np.ones((first.shape[0], 2), dtype=bool)
+  keep_k2[:, 1] = right != left
+  return torch.from_numpy(points_k22[keep_k2])
+
+# Converts a mask into row runs, in row-major order
+def mask_to_row_runs(test_mask):
+  foreground = np.asarray(test_mask == 1, dtype=np.int8)
+  padded = np.pad(foreground, ((0, 0), (1, 1)))
+  edges = np.diff(padded, axis=1)
+  rows, starts = np.nonzero(edges == 1)
+  _, stops = np.nonzero(edges == -1)
+  return rows, starts, stops
+
+def get_tight_polygon_from_mask_fast(test_mask):
+  mask_points_n2 = boundary_points_from_mask(test_mask)
+  return torch.from_numpy(convex_hull_monotone_chain(mask_points_n2.cpu().numpy()))
+
+# Removes the points that lie in between their neighbours on a straight hull
+# edge, so the gift wrapping output can be compared vertex by vertex with the
+# monotone chain output
+def drop_collinear_vertices(polygon_points_n2):
+  points = [tuple(p) for p in np.asarray(polygon_points_n2).tolist()]
+  changed = len(points) >= 3
+  while changed and len(points) >= 3:
+    changed = False
+    for i in range(len(points)):
+      p, q, r = points[i - 1], points[i], points[(i + 1) % len(points)]
+      between = (p[0] - q[0]) * (r[0] - q[0]) + (p[1] - q[1]) * (r[1] - q[1]) < 0
+      if cross_product(p, q, r) == 0 and between:
+        del points[i]
+        changed = True
+        break
+  return np.array(points, dtype=np.int64).reshape(-1, 2)
+
+## NOTE: Only used for verification. This section can be skipped.
+
+# Correctness check of the monotone chain against gift wrapping on random
+# blobs, lines and single points
+check_rng = np.random.RandomState(0)
+for trial in range(50):
+  h, w = check_rng.randint(1, 40, size=2)
+  check_mask = torch.from_numpy((check_rng.rand(h, w) < check_rng.uniform(0.01, 0.5)).astype(np.uint8))
+  if check_mask.sum() == 0:
+    continue
+  expected = drop_collinear_vertices(get_tight_polygon_from_mask(check_mask).numpy())
+  actual = get_tight_polygon_from_mask_fast(check_mask).numpy()
+  assert np.array_equal(expected, actual), (trial, expected, actual)
+print("Monotone chain matches gift wrapping")
+
+## NOTE: Only used for benchmarking. This section can be skipped.
+
+# Filled ellipse covering roughly the same fraction of the image as the
+# turtle in the test image
+def make_ellipse_mask(resolution, fill=0.1):
+  radius = np.sqrt(fill * resolution * resolution / (np.pi * 0.6))
+  rows, cols = np.mgrid[:resolution, :resolution]
+  center = resolution / 2
+  inside = ((rows - center) / (0.6 * radius)) ** 2 + ((cols - center) / radius) ** 2 <= 1
+  return torch.from_numpy(inside.astype(np.uint8))
+
+# Gift wrapping at 2048x2048 takes hours, so above jarvis_max_resolution its
+# time is extrapolated from the per (n * v) cost measured at lower resolutions
+def benchmark_convex_hull(resolutions=(256, 512, 2048), jarvis_max_resolution=512):
+  jarvis_cost_per_nv = None
+  for resolution in resolutions:
+    bench_mask = make_ellipse_mask(resolution)
+    n = int(bench_mask.sum())
+
+    start = time.perf_counter()
+    fast_polygon = get_tight_polygon_from_mask_fast(bench_mask)
+    fast_time = time.perf_counter() - start
+    v = fast_polygon.shape[0]
+
+    if resolution <= jarvis_max_resolution:
+      start = time.perf_counter()
+      get_tight_polygon_from_mask(bench_mask)
+      jarvis_time = time.perf_counter() - start
+      jarvis_cost_per_nv = jarvis_time / (n * v)
+      estimated = ""
+    else:
+      jarvis_time = jarvis_cost_per_nv * n * v
+      estimated = " (estimated)"
+
+    print("{0}x{0}: n={1} v={2} jarvis={3:.3f}s{4} monotone chain={5:.4f}s speedup={6:.0f}x".format(
+        resolution, n, v, jarvis_time, estimated, fast_time, jarvis_time / fast_time))
+
+benchmark_convex_hull()
+
+## NOTE: Only used for benchmarking. This section can be skipped.
+
+# Compares feeding every foreground pixel from torch.where into the hull with
+# feeding only the row boundary points, computed either from the full mask or
+# from its row runs. Memory is the size of the point tensor handed to the hull
+# algorithm, which for the torch.where path is 16 bytes per foreground pixel.
+def benchmark_boundary_candidates(resolution=4096, fill=0.5):
+  bench_mask = make_ellipse_mask(resolution, fill)
+  bench_runs = mask_to_row_runs(bench_mask.numpy())
+
+  def all_pixels():
+    return torch.stack(torch.where(bench_mask == 1), 1)
+
+  def from_mask():
+    return boundary_points_from_mask(bench_mask)
+
+  def from_row_runs():
+    return boundary_points_from_row_runs(*bench_runs)
+
+  # the memory column is the peak memory allocated while finding the
+  # candidates, including the temporaries (the resident memory of the
+  # process above what it held before the call)
+  for name, get_points in [('torch.where', all_pixels), ('boundary (mask)', from_mask), ('boundary (row runs)', from_row_runs)]:
+    peak_reset = reset_peak_rss()
+    rss_before = read_rss_mb()[0]
+    start = time.perf_counter()
+    points_n2 = get_points()
+    points_time = time.perf_counter() - start
+    peak_mb = read_rss_mb()[1] - rss_before if peak_reset else float('nan')
+    start = time.perf_counter()
+    polygon = convex_hull_monotone_chain(points_n2.numpy())
+    hull_time = time.perf_counter() - start
+    print("{}: {} points, peak {:.1f} MB, candidates {:.3f}s, hull {:.3f}s, {} vertices".format(
+        name, points_n2.shape[0], peak_mb, points_time, hull_time, polygon.shape[0]))
+
+benchmark_boundary_candidates()
+
+polygon_points_n2_tensor = get_tight_polygon_from_mask_fast(test_mask_tensor)
 visualize_polygon_on_image(test_image_tensor, polygon_points_n2_tensor)
 visualize_polygon_on_image(test_mask_tensor[None], polygon_points_n2_tensor)
 
@@ -526,11 +1739,1519 @@ def calculate_polygon_area(polygon_points_n2):
   # Add areas from v - 2 triangles to get the area of the convex hull
   return area_triangle(p, q, r) + calculate_polygon_area(polygon_points_n2[1:])
 
-print("Area = {:.4f}".format(calculate_polygon_area(polygon_points_n2_tensor)))
+# The recursion above copies the remaining vertices at every step, which is
+# O(v^2), and hits Python's recursion limit on hulls of high resolution masks.
+# The shoelace formula below computes the same area in a single vectorized
+# pass. Twice the area is accumulated as an integer, so for a convex polygon
+# with integer vertices the result is exactly the sum of the v - 2 triangles.
+
+# Areas of a padded batch of polygons: points_bv2 holds B polygons padded to V
+# vertices, and the first lengths_b[i] vertices of polygon i are valid
+def calculate_polygon_areas_padded(points_bv2, lengths_b):
+  points_bv2 = torch.as_tensor(points_bv2)
+  lengths_b = torch.as_tensor(lengths_b, device=points_bv2.device)
+  num_vertices = points_bv2.shape[1]
+  idx_v = torch.arange(num_vertices, device=points_bv2.device)
+  # index of the next vertex, wrapping around at the end of every polygon
+  next_idx_bv = (idx_v[None] + 1) % lengths_b.clamp(min=1)[:, None]
+  next_points_bv2 = torch.gather(points_bv2, 1, next_idx_bv[..., None].expand(-1, -1, 2))
+  terms_bv = points_bv2[..., 0] * next_points_bv2[..., 1] - next_points_bv2[..., 0] * points_bv2[..., 1]
+  terms_bv = torch.where(idx_v[None] < lengths_b[:, None], terms_bv, torch.zeros_like(terms_bv))
+  return terms_bv.sum(1).abs().double() / 2
+
+# Areas of B polygons stored back to back in points_n2, where polygon i is
+# points_n2[offsets[i]:offsets[i + 1]]
+def calculate_polygon_areas_ragged(points_n2, offsets):
+  points_n2 = torch.as_tensor(points_n2)
+  offsets = torch.as_tensor(offsets, device=points_n2.device)
+  lengths_b = offsets[1:] - offsets[:-1]
+  polygon_ids_n = torch.repeat_interleave(torch.arange(lengths_b.shape[0], device=points_n2.device), lengths_b)
+  next_idx_n = torch.arange(1, points_n2.shape[0] + 1, device=points_n2.device)
+  # the last vertex of every polygon is followed by its first vertex
+  last = offsets[1:][lengths_b > 0] - 1
+  next_idx_n[last] = offsets[:-1][lengths_b > 0]
+  next_points_n2 = points_n2[next_idx_n.clamp(max=max(points_n2.shape[0] - 1, 0))]
+  terms_n = points_n2[:, 0] * next_points_n2[:, 1] - next_points_n2[:, 0] * points_n2[:, 1]
+  twice_area_b = torch.zeros(lengths_b.shape[0], dtype=terms_n.dtype, device=points_n2.device)
+  twice_area_b.index_add_(0, polygon_ids_n, terms_n)
+  return twice_area_b.abs().double() / 2
+
+def calculate_polygon_area_fast(polygon_points_n2):
+  polygon_points_n2 = torch.as_tensor(polygon_points_n2)
+  lengths = torch.tensor([polygon_points_n2.shape[0]])
+  return calculate_polygon_areas_padded(polygon_points_n2[None], lengths)[0].item()
+
+## NOTE: Only used for verification. This section can be skipped.
+
+# Compares the shoelace areas against the triangle decomposition on random
+# hulls, as a single polygon, as a padded batch and in the ragged form
+check_rng = np.random.RandomState(0)
+check_polygons = []
+for _ in range(50):
+  check_points = check_rng.randint(0, 512, size=(check_rng.randint(1, 200), 2))
+  check_polygons.append(torch.from_numpy(convex_hull_monotone_chain(check_points)))
+expected = [float(calculate_polygon_area(polygon)) for polygon in check_polygons]
+lengths = torch.tensor([polygon.shape[0] for polygon in check_polygons])
+padded = torch.nn.utils.rnn.pad_sequence(check_polygons, batch_first=True)
+offsets = torch.cat([torch.zeros(1, dtype=torch.int64), lengths.cumsum(0)])
+assert [calculate_polygon_area_fast(polygon) for polygon in check_polygons] == expected
+assert calculate_polygon_areas_padded(padded, lengths).tolist() == expected
+assert calculate_polygon_areas_ragged(torch.cat(check_polygons), offsets).tolist() == expected
+print("Shoelace areas match the triangle decomposition")
+
+## NOTE: Only used for benchmarking. This section can be skipped.
+
+def benchmark_polygon_areas(num_polygons=10000, num_points=200):
+  bench_rng = np.random.RandomState(0)
+  polygons = [torch.from_numpy(convex_hull_monotone_chain(bench_rng.randint(0, 2048, size=(num_points, 2))))
+              for _ in range(num_polygons)]
+  lengths = torch.tensor([polygon.shape[0] for polygon in polygons])
+  padded = torch.nn.utils.rnn.pad_sequence(polygons, batch_first=True)
+  points_n2 = torch.cat(polygons)
+  offsets = torch.cat([torch.zeros(1, dtype=torch.int64), lengths.cumsum(0)])
+
+  for name, compute in [('one by one', lambda: [calculate_polygon_area_fast(polygon) for polygon in polygons]),
+                        ('padded', lambda: calculate_polygon_areas_padded(padded, lengths)),
+                        ('ragged', lambda: calculate_polygon_areas_ragged(points_n2, offsets))]:
+    start = time.perf_counter()
+    compute()
+    elapsed = time.perf_counter() - start
+    print("{}: {:.0f} polygons/s".format(name, num_polygons / elapsed))
+
+benchmark_polygon_areas()
+
+print("Area = {:.4f}".format(calculate_polygon_area_fast(polygon_points_n2_tensor)))
 
 # Area comes out as 24691.00 with the given test image, training checkpoint
 # checkpoint36.pth and given random seeds
 
+"""# Mask sequences
+For frame sequences of the same scene, consecutive masks differ in a few pixels only. `IncrementalConvexHull` keeps the hull, its area and the left-most / right-most foreground pixel of every row up to date as foreground pixels are added and removed, without rescanning all foreground pixels. Added pixels outside the hull are merged with the current hull vertices. Only a removed hull vertex forces a recompute, and that one runs on the at most 2 x H row boundary points.
+"""
+
+class IncrementalConvexHull:
+  def __init__(self, mask):
+    self.mask = np.array(mask == 1, dtype=bool)
+    height = self.mask.shape[0]
+    self.left = np.full(height, -1, dtype=np.int64)
+    self.right = np.full(height, -1, dtype=np.int64)
+    self.rescan_rows(np.arange(height))
+    self.num_recomputes = 0
+    self.recompute_hull()
+
+  # Recomputes the row extents of the given rows from the mask
+  def rescan_rows(self, rows):
+    for row in rows:
+      cols = np.flatnonzero(self.mask[row])
+      self.left[row], self.right[row] = (cols[0], cols[-1]) if cols.shape[0] else (-1, -1)
+
+  def boundary_points(self):
+    rows = np.flatnonzero(self.left >= 0)
+    return boundary_points_from_row_runs(rows, self.left[rows], self.right[rows] + 1).numpy()
+
+  def set_hull(self, polygon_points_n2):
+    self.polygon_points_n2 = polygon_points_n2
+    self.hull_vertices = set(map(tuple, polygon_points_n2.tolist()))
+    self.area = calculate_polygon_area_fast(polygon_points_n2)
+
+  def recompute_hull(self):
+    self.num_recomputes += 1
+    self.set_hull(convex_hull_monotone_chain(self.boundary_points()))
+
+  # Which of the points lie outside of the current hull. The hull is
+  # counter-clockwise in (col, row) coordinates, so a point is inside or on the
+  # hull if it is on the left of or on every edge.
+  def outside_hull(self, points_k2):
+    hull = self.polygon_points_n2
+    if hull.shape[0] < 3:
+      return np.ones(points_k2.shape[0], dtype=bool)
+    start, end = hull, np.roll(hull, -1, axis=0)
+    cross_kv = ((end[None, :, 1] - start[None, :, 1]) * (points_k2[:, None, 0] - start[None, :, 0])
+                - (end[None, :, 0] - start[None, :, 0]) * (points_k2[:, None, 1] - start[None, :, 1]))
+    return (cross_kv < 0).any(1)
+
+  # Applies a change of the mask given as (row, col) points that became
+  # foreground and background
+  def update(self, added_points=None, removed_points=None):
+    added = np.zeros((0, 2), dtype=np.int64) if added_points is None else np.asarray(added_points, dtype=np.int64).reshape(-1, 2)
+    removed = np.zeros((0, 2), dtype=np.int64) if removed_points is None else np.asarray(removed_points, dtype=np.int64).reshape(-1, 2)
+    self.mask[removed[:, 0], removed[:, 1]] = False
+    self.mask[added[:, 0], added[:, 1]] = True
+
+    # rows that lost one of their extreme pixels are rescanned
+    lost_extreme = (removed[:, 1] == self.left[removed[:, 0]]) | (removed[:, 1] == self.right[removed[:, 0]])
+    for row, col in added.tolist():
+      if self.left[row] < 0 or col < self.left[row]:
+        self.left[row] = col
+      if col > self.right[row]:
+        self.right[row] = col
+    self.rescan_rows(np.unique(removed[lost_extreme, 0]))
+
+    if any(tuple(point) in self.hull_vertices for point in removed.tolist()):
+      self.recompute_hull()
+    else:
+      # only added points outside the hull can change it
+      added = added[self.outside_hull(added)]
+      if added.shape[0]:
+        self.set_hull(convex_hull_monotone_chain(np.concatenate([self.polygon_points_n2, added])))
+    return self.polygon_points_n2, self.area
+
+  # Applies the difference between the current mask and the new one
+  def update_from_mask(self, new_mask):
+    new_mask = np.asarray(new_mask == 1, dtype=bool)
+    changed = np.argwhere(new_mask != self.mask)
+    is_added = new_mask[changed[:, 0], changed[:, 1]]
+    return self.update(changed[is_added], changed[~is_added])
+
+## NOTE: Only used for benchmarking. This section can be skipped.
+
+# A turtle mask from random_paste moving one pixel every few frames, with a
+# few pixels inside the turtle flickering in every frame like segmentation noise
+def make_moving_turtle_masks(num_frames=200, resolution=512, seed=0):
+  rng = np.random.RandomState(seed)
+  background = Image.new('RGB', (resolution, resolution))
+  _, canvas = random_paste(background, turtle_image.resize((resolution, resolution)), 0.3, 0.4,
+                           rng=random.Random(seed))
+  turtle_mask = np.asarray(canvas)[:, :, 3] > 0
+  masks = []
+  offset = np.zeros(2, dtype=np.int64)
+  for frame in range(num_frames):
+    if frame % 4 == 0:
+      offset += rng.randint(-1, 2, size=2)
+    mask = np.roll(turtle_mask, tuple(offset), axis=(0, 1))
+    inside = np.argwhere(mask)
+    noise = inside[rng.randint(0, inside.shape[0], size=20)]
+    mask[noise[:, 0], noise[:, 1]] = False
+    masks.append(mask.astype(np.uint8))
+  return masks
+
+def benchmark_incremental_hull(num_frames=200, resolution=512):
+  masks = make_moving_turtle_masks(num_frames, resolution)
+
+  start = time.perf_counter()
+  full_polygons = [get_tight_polygon_from_mask_fast(torch.from_numpy(mask)).numpy() for mask in masks]
+  full_time = time.perf_counter() - start
+
+  start = time.perf_counter()
+  incremental_hull = IncrementalConvexHull(masks[0])
+  incremental_polygons = [incremental_hull.polygon_points_n2]
+  for mask in masks[1:]:
+    incremental_polygons.append(incremental_hull.update_from_mask(mask)[0])
+  diff_time = time.perf_counter() - start
+  assert all(np.array_equal(a, b) for a, b in zip(full_polygons, incremental_polygons))
+
+  # With the changed pixels already known (e.g. from a tracker) there is no
+  # pass over the whole frame at all
+  changes = []
+  for previous, mask in zip(masks, masks[1:]):
+    changed = np.argwhere(mask != previous)
+    is_added = mask[changed[:, 0], changed[:, 1]] == 1
+    changes.append((changed[is_added], changed[~is_added]))
+  start = time.perf_counter()
+  incremental_hull = IncrementalConvexHull(masks[0])
+  for added, removed in changes:
+    incremental_hull.update(added, removed)
+  update_time = time.perf_counter() - start
+  assert np.array_equal(incremental_hull.polygon_points_n2, full_polygons[-1])
+
+  print("{} frames of {}x{}: full {:.2f} ms/frame, incremental from masks {:.2f} ms/frame, "
+        "incremental from changed pixels {:.2f} ms/frame, {} recomputes".format(
+      num_frames, resolution, resolution, full_time / num_frames * 1000, diff_time / num_frames * 1000,
+      update_time / num_frames * 1000, incremental_hull.num_recomputes))
+
+benchmark_incremental_hull()
+
+"""# Connected components
+A single hull over every foreground pixel is inflated by stray false positive pixels far away from the turtle, and it can not separate several turtles in one image. `label_row_runs` labels the 8-connected (or 4-connected) components of a mask with a two-pass union-find over its row runs: the first pass unions every run with the runs it touches in the row above, the second pass resolves every run to its root. Each run only touches the runs of the previous row that overlap it, so the number of unions is linear in the number of runs. Components smaller than `min_component_size` pixels are dropped before their hulls are computed.
+"""
+
+def find_root(parent, i):
+  while parent[i] != i:
+    # path halving
+    parent[i] = parent[parent[i]]
+    i = parent[i]
+  return i
+
+# Labels the row runs of a mask (in row-major order, as from mask_to_row_runs)
+# by connected component. Returns the label of every run, 0 ... K - 1
+def label_row_runs(rows, starts, stops, connectivity=8):
+  rows, starts, stops = (np.asarray(a, dtype=np.int64) for a in (rows, starts, stops))
+  num_runs = rows.shape[0]
+  if num_runs == 0:
+    return np.zeros(0, dtype=np.int64), 0
+  # with 8-connectivity runs touching diagonally are connected as well
+  reach = 1 if connectivity == 8 else 0
+  # (row, col) keys, increasing in row-major order for the starts and the stops
+  stride = stops.max() + 2
+  start_keys = rows * stride + starts
+  stop_keys = rows * stride + stops
+  # run j in the row above touches run i if stops[j] + reach > starts[i] and
+  # starts[j] < stops[i] + reach, which is a contiguous range of runs
+  lo = np.searchsorted(stop_keys, (rows - 1) * stride + starts - reach, side='right')
+  hi = np.searchsorted(start_keys, (rows - 1) * stride + stops + reach, side='left')
+  counts = np.maximum(hi - lo, 0)
+  run_ids = np.repeat(np.arange(num_runs), counts)
+  above_ids = np.repeat(lo - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+
+  # first pass: union the runs touching in neighbouring rows
+  parent = list(range(num_runs))
+  for i, j in zip(run_ids.tolist(), above_ids.tolist()):
+    root_i, root_j = find_root(parent, i), find_root(parent, j)
+    if root_i != root_j:
+      parent[max(root_i, root_j)] = min(root_i, root_j)
+
+  # second pass: resolve every run to its root and number the roots
+  roots = np.array([find_root(parent, i) for i in range(num_runs)], dtype=np.int64)
+  _, labels = np.unique(roots, return_inverse=True)
+  return labels.reshape(-1), labels.max() + 1
+
+# Hulls, hull areas and pixel counts of the connected components of a mask
+# with at least min_component_size pixels, largest component first
+def get_component_polygons_from_row_runs(rows, starts, stops, min_component_size=1, connectivity=8):
+  rows, starts, stops = (np.asarray(a, dtype=np.int64) for a in (rows, starts, stops))
+  labels, num_components = label_row_runs(rows, starts, stops, connectivity)
+  sizes = np.bincount(labels, weights=stops - starts, minlength=num_components).astype(np.int64)
+  kept = np.flatnonzero(sizes >= min_component_size)
+  kept = kept[np.argsort(-sizes[kept], kind='stable')]
+
+  # group the runs by component, keeping the row-major order within each
+  order = np.argsort(labels, kind='stable')
+  offsets = np.r_[0, np.cumsum(np.bincount(labels, minlength=num_components))]
+  polygons = []
+  for component in kept.tolist():
+    runs = order[offsets[component]:offsets[component + 1]]
+    boundary_points = boundary_points_from_row_runs(rows[runs], starts[runs], stops[runs])
+    polygons.append(torch.from_numpy(convex_hull_monotone_chain(boundary_points.numpy())))
+  lengths = torch.tensor([polygon.shape[0] for polygon in polygons], dtype=torch.int64)
+  polygon_offsets = torch.cat([torch.zeros(1, dtype=torch.int64), torch.cumsum(lengths, 0)])
+  points_n2 = torch.cat(polygons) if polygons else torch.zeros(0, 2, dtype=torch.int64)
+  areas = calculate_polygon_areas_ragged(points_n2, polygon_offsets)
+  return polygons, areas, torch.from_numpy(sizes[kept])
+
+def get_component_polygons_from_mask(test_mask, min_component_size=1, connectivity=8):
+  rows, starts, stops = mask_to_row_runs(np.asarray(test_mask))
+  return get_component_polygons_from_row_runs(rows, starts, stops, min_component_size, connectivity)
+
+## NOTE: Only used for verification and benchmarking. This section can be skipped.
+
+# The components agree with a flood fill, and the hull of a component agrees
+# with the hull of its pixels
+def flood_fill_labels(mask, connectivity=8):
+  height, width = mask.shape
+  labels = np.full(mask.shape, -1, dtype=np.int64)
+  if connectivity == 8:
+    steps = [(dr, dc) for dr in (-1, 0, 1) for dc in (-1, 0, 1) if (dr, dc) != (0, 0)]
+  else:
+    steps = [(-1, 0), (1, 0), (0, -1), (0, 1)]
+  num_components = 0
+  for r, c in zip(*np.nonzero(mask)):
+    if labels[r, c] >= 0:
+      continue
+    labels[r, c] = num_components
+    stack = [(r, c)]
+    while stack:
+      pr, pc = stack.pop()
+      for dr, dc in steps:
+        qr, qc = pr + dr, pc + dc
+        if 0 <= qr < height and 0 <= qc < width and mask[qr, qc] and labels[qr, qc] < 0:
+          labels[qr, qc] = num_components
+          stack.append((qr, qc))
+    num_components += 1
+  return labels, num_components
+
+check_rng = np.random.RandomState(0)
+for _ in range(100):
+  check_mask = (check_rng.rand(*check_rng.randint(1, 40, size=2)) < check_rng.rand()).astype(np.uint8)
+  for connectivity in (4, 8):
+    rows, starts, stops = mask_to_row_runs(check_mask)
+    run_labels, num_components = label_row_runs(rows, starts, stops, connectivity)
+    expected_labels, expected_num_components = flood_fill_labels(check_mask, connectivity)
+    assert num_components == expected_num_components
+    # the labels agree up to numbering if the run labels map one to one onto
+    # the flood fill labels
+    pairs = set(zip(run_labels.tolist(), expected_labels[rows, starts].tolist()))
+    assert len(pairs) == num_components
+    polygons, areas, sizes = get_component_polygons_from_mask(check_mask, connectivity=connectivity)
+    assert sizes.sum().item() == check_mask.sum()
+    for polygon, area in zip(polygons, areas.tolist()):
+      component = np.zeros_like(check_mask)
+      component_label = expected_labels[tuple(polygon[0].tolist())]
+      component[expected_labels == component_label] = 1
+      assert np.array_equal(polygon.numpy(), get_tight_polygon_from_mask_fast(torch.from_numpy(component)).numpy())
+      assert area == calculate_polygon_area_fast(polygon)
+
+# Labeling time per run on random masks of growing size, which stays flat if
+# the labeling is linear in the number of runs. The hulls are only computed for
+# the components that pass the size filter
+def benchmark_component_labeling(resolutions=(256, 512, 1024, 2048), density=0.3, min_component_size=20):
+  rng = np.random.RandomState(0)
+  for resolution in resolutions:
+    mask = (rng.rand(resolution, resolution) < density).astype(np.uint8)
+    rows, starts, stops = mask_to_row_runs(mask)
+    start = time.perf_counter()
+    _, num_components = label_row_runs(rows, starts, stops)
+    label_time = time.perf_counter() - start
+    start = time.perf_counter()
+    polygons, _, _ = get_component_polygons_from_row_runs(rows, starts, stops, min_component_size)
+    total_time = time.perf_counter() - start
+    print("{}x{}: {} runs, {} components ({} kept), labeling {:.0f} ms ({:.2f} us/run), with hulls {:.0f} ms".format(
+        resolution, resolution, rows.shape[0], num_components, len(polygons),
+        label_time * 1000, label_time / rows.shape[0] * 1e6, total_time * 1000))
+
+benchmark_component_labeling()
+
+# With the stray false positive pixels dropped, only the turtle is left
+component_polygons, component_areas, component_sizes = get_component_polygons_from_mask(test_mask_tensor, min_component_size=50)
+for polygon, area, size in zip(component_polygons, component_areas.tolist(), component_sizes.tolist()):
+  print("Component of {} pixels: {} hull vertices, area = {:.4f}".format(size, polygon.shape[0], area))
+
+"""# Row run masks
+A dense mask takes a byte per pixel, and `torch.where` turns its foreground into an N x 2 int64 tensor, 16 bytes per foreground pixel, before the hull code runs. `RowRunMask` stores a mask as its row runs instead: the row, first column and one past the last column of every horizontal run of foreground pixels. The runs are extracted from the thresholded logits on the device the model runs on, so only the runs are copied back to the CPU. The hull, area and component code all work on the runs directly, and `to_bytes` stores the run counts per row and the run starts and lengths as zlib compressed 16 bit integers.
+"""
+
+import zlib
+
+class RowRunMask:
+  def __init__(self, rows, starts, stops, shape):
+    self.rows = np.asarray(rows, dtype=np.int32)
+    self.starts = np.asarray(starts, dtype=np.int32)
+    self.stops = np.asarray(stops, dtype=np.int32)
+    self.shape = tuple(int(n) for n in shape)
+
+  @classmethod
+  def from_mask(cls, test_mask):
+    test_mask = test_mask.cpu().numpy() if torch.is_tensor(test_mask) else np.asarray(test_mask)
+    return cls(*mask_to_row_runs(test_mask), test_mask.shape)
+
+  # Thresholds a H x W logit map like get_mask_from_image and extracts the runs
+  # on the device of the logits
+  @classmethod
+  def from_logits(cls, logits_hw, threshold=0.5):
+    foreground = F.pad((logits_hw > threshold).to(torch.int8), (1, 1))
+    edges = foreground[:, 1:] - foreground[:, :-1]
+    # in row-major order the edges of every row alternate between the start
+    # and the stop of a run, so a single nonzero finds both
+    rows, cols = torch.nonzero(edges, as_tuple=True)
+    return cls(rows[0::2].cpu().numpy(), cols[0::2].cpu().numpy(), cols[1::2].cpu().numpy(), logits_hw.shape)
+
+  def to_dense(self):
+    # +1 at the start and -1 at the stop of every run, summed along the rows
+    edges = np.zeros((self.shape[0], self.shape[1] + 1), dtype=np.int8)
+    edges[self.rows, self.starts] = 1
+    edges[self.rows, self.stops] -= 1
+    return torch.from_numpy(np.cumsum(edges, axis=1, dtype=np.int8)[:, :-1].astype(np.uint8))
+
+  @property
+  def nbytes(self):
+    return self.rows.nbytes + self.starts.nbytes + self.stops.nbytes
+
+  def foreground_pixels(self):
+    return int((self.stops - self.starts).sum())
+
+  def boundary_points(self):
+    return boundary_points_from_row_runs(self.rows, self.starts, self.stops)
+
+  def polygon(self):
+    return torch.from_numpy(convex_hull_monotone_chain(self.boundary_points().numpy()))
+
+  def components(self, min_component_size=1, connectivity=8):
+    return get_component_polygons_from_row_runs(self.rows, self.starts, self.stops, min_component_size, connectivity)
+
+  # Height, width and the number of runs, followed by the number of runs in
+  # every row and the start and length of every run
+  def to_bytes(self):
+    assert max(self.shape) < 2 ** 16, "Masks are stored with 16 bit coordinates"
+    header = np.array([self.shape[0], self.shape[1], self.rows.shape[0]], dtype=np.uint32)
+    row_counts = np.bincount(self.rows, minlength=self.shape[0]).astype(np.uint16)
+    lengths = (self.stops - self.starts).astype(np.uint16)
+    return zlib.compress(header.tobytes() + row_counts.tobytes() + self.starts.astype(np.uint16).tobytes()
+                         + lengths.tobytes())
+
+  @classmethod
+  def from_bytes(cls, data):
+    data = zlib.decompress(data)
+    height, width, num_runs = np.frombuffer(data, dtype=np.uint32, count=3)
+    values = np.frombuffer(data, dtype=np.uint16, offset=12).astype(np.int32)
+    row_counts, starts, lengths = np.split(values, [height, height + num_runs])
+    rows = np.repeat(np.arange(height, dtype=np.int32), row_counts)
+    return cls(rows, starts, starts + lengths, (height, width))
+
+def get_row_run_mask_from_image(test_image):
+  with torch.inference_mode():
+    return RowRunMask.from_logits(unet(test_image.to(device)[None], (512, 512))[0, 0])
+
+## NOTE: Only used for verification and benchmarking. This section can be skipped.
+
+# Row run masks agree with the dense masks on random masks and the test mask
+check_rng = np.random.RandomState(0)
+for check_mask in [test_mask_tensor] + [torch.from_numpy((check_rng.rand(*check_rng.randint(1, 60, size=2)) < check_rng.rand()).astype(np.uint8)) for _ in range(100)]:
+  row_run_mask = RowRunMask.from_mask(check_mask)
+  assert torch.equal(row_run_mask.to_dense(), check_mask)
+  assert torch.equal(RowRunMask.from_logits(check_mask.float()).to_dense(), check_mask)
+  assert torch.equal(RowRunMask.from_bytes(row_run_mask.to_bytes()).to_dense(), check_mask)
+  assert row_run_mask.foreground_pixels() == check_mask.sum().item()
+  if check_mask.any():
+    assert torch.equal(row_run_mask.polygon(), get_tight_polygon_from_mask_fast(check_mask))
+
+# Memory and time of the dense path (byte mask, foreground points, hull, area)
+# against the row run path (runs from the logits, hull, area), on the turtle
+# mask scaled to growing resolutions
+def benchmark_row_run_masks(resolutions=(512, 1024, 2048, 4096), repeats=5):
+  for resolution in resolutions:
+    logits = F.interpolate(test_mask_tensor[None, None].float(), size=(resolution, resolution))[0, 0].to(device)
+
+    def dense_path():
+      test_mask = (logits > 0.5).byte().cpu()
+      mask_points_n2 = torch.stack(torch.where(test_mask == 1), 1)
+      polygon_points_n2 = torch.from_numpy(convex_hull_monotone_chain(boundary_points_from_mask(test_mask).numpy()))
+      return test_mask, mask_points_n2, calculate_polygon_area_fast(polygon_points_n2)
+
+    def row_run_path():
+      row_run_mask = RowRunMask.from_logits(logits)
+      return row_run_mask, calculate_polygon_area_fast(row_run_mask.polygon())
+
+    timings = {}
+    for name, compute in [('dense', dense_path), ('row runs', row_run_path)]:
+      compute()
+      start = time.perf_counter()
+      for _ in range(repeats):
+        result = compute()
+      timings[name] = (time.perf_counter() - start) / repeats * 1000
+    test_mask, mask_points_n2, dense_area = dense_path()
+    row_run_mask, row_run_area = row_run_path()
+    assert dense_area == row_run_area
+    print("{}x{}: dense {:.1f} MB ({:.1f} ms), row runs {:.1f} KB in memory, {:.1f} KB stored ({:.1f} ms)".format(
+        resolution, resolution, (test_mask.numel() + mask_points_n2.numel() * 8) / 2 ** 20, timings['dense'],
+        row_run_mask.nbytes / 2 ** 10, len(row_run_mask.to_bytes()) / 2 ** 10, timings['row runs']))
+
+benchmark_row_run_masks()
+
+"""# Checkpoint evaluation
+Instead of choosing a checkpoint from a grid of predicted test masks, every checkpoint is scored on a held-out synthetic validation set: IoU and Dice of the masks, the relative error of the convex hull area and the inference latency. Checkpoints are evaluated in parallel by a process pool that shares the validation batch read-only.
+"""
+
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+# The validation backgrounds come from their own seeds, so none of them is
+# used for training
+def make_validation_set(num_samples=256, base_seed=10 ** 6, seed=0):
+  validation_store = background_store + '-validation'
+  if not background_shards_complete(validation_store, num_samples, shard_size=1024):
+    model = BigGAN.from_pretrained('biggan-deep-256') if use_biggan else TinyBackgroundGenerator()
+    generate_background_shards(model.to(device).eval(), validation_store, num_samples,
+                               truncation=truncation, base_seed=base_seed)
+    del model
+  validation_backgrounds = BackgroundShardImages(load_background_shards(validation_store)[0])
+  rng = random.Random(seed)
+  pairs = [make_training_pair(*random_paste(background.copy(), turtle_image_256x256.copy(), rng=rng))
+           for background in validation_backgrounds]
+  images = torch.stack([image for image, _ in pairs])
+  masks = torch.stack([mask for _, mask in pairs])
+  return images, masks
+
+def mask_hull_area(mask):
+  return calculate_polygon_area_fast(get_tight_polygon_from_mask_fast(mask))
+
+# Set in every pool worker by init_evaluation_worker. With fork the tensors
+# are inherited from the parent process instead of being copied.
+evaluation_data = {}
+
+def init_evaluation_worker(images, masks, hull_areas, num_threads):
+  torch.set_num_threads(num_threads)
+  evaluation_data.update(images=images, masks=masks, hull_areas=hull_areas)
+
+def evaluate_checkpoint(path, batch_size=16):
+  images, masks, hull_areas = evaluation_data['images'], evaluation_data['masks'], evaluation_data['hull_areas']
+  model, header = load_unet_checkpoint(path, 'cpu')
+  predictions = []
+  start = time.perf_counter()
+  with torch.inference_mode():
+    for batch_start in range(0, images.shape[0], batch_size):
+      batch = images[batch_start:batch_start + batch_size]
+      predictions.append(model(batch, tuple(batch.shape[-2:])) > 0.5)
+  latency = (time.perf_counter() - start) / images.shape[0]
+  predictions = torch.cat(predictions)
+
+  intersection = (predictions & masks).sum((1, 2, 3)).float()
+  pred_area = predictions.sum((1, 2, 3)).float()
+  gt_area = masks.sum((1, 2, 3)).float()
+  union = pred_area + gt_area - intersection
+  # an empty prediction of an empty mask is a perfect score
+  iou = torch.where(union > 0, intersection / union.clamp(min=1), torch.ones_like(union))
+  dice = torch.where(union > 0, 2 * intersection / (pred_area + gt_area).clamp(min=1), torch.ones_like(union))
+  pred_hull_areas = torch.tensor([mask_hull_area(prediction[0]) for prediction in predictions], dtype=torch.float64)
+  hull_area_error = (pred_hull_areas - hull_areas).abs() / hull_areas.clamp(min=1)
+  return {
+      'checkpoint': os.path.basename(path),
+      'epoch': header['epoch'],
+      'iou': iou.mean().item(),
+      'dice': dice.mean().item(),
+      'hull_area_error': hull_area_error.mean().item(),
+      'latency_ms': latency * 1000,
+  }
+
+# Returns the scores of all checkpoints, best IoU first
+def evaluate_checkpoints(paths, images, masks, num_workers=None):
+  num_workers = num_workers or min(len(paths), os.cpu_count())
+  hull_areas = torch.tensor([mask_hull_area(mask[0]) for mask in masks], dtype=torch.float64)
+  for tensor in (images, masks, hull_areas):
+    tensor.share_memory_()
+  with ProcessPoolExecutor(num_workers, mp_context=multiprocessing.get_context('fork'),
+                           initializer=init_evaluation_worker,
+                           initargs=(images, masks, hull_areas, max(1, os.cpu_count() // num_workers))) as pool:
+    results = list(pool.map(evaluate_checkpoint, paths))
+  return sorted(results, key=lambda result: result['iou'], reverse=True)
+
+def print_checkpoint_table(results):
+  print("{:<18} {:>5} {:>7} {:>7} {:>10} {:>11}".format('checkpoint', 'epoch', 'IoU', 'Dice', 'area err', 'latency ms'))
+  for result in results:
+    print("{checkpoint:<18} {epoch:>5} {iou:>7.4f} {dice:>7.4f} {hull_area_error:>10.2%} {latency_ms:>11.2f}".format(**result))
+
+## NOTE: Only used for experimentation. This section can be skipped.
+
+validation_images, validation_masks = make_validation_set()
+checkpoint_results = evaluate_checkpoints(
+    [model_save_location + f"/checkpoint{i}.pt" for i in range(40)], validation_images, validation_masks)
+print_checkpoint_table(checkpoint_results)
+
+"""# Quantized CPU inference
+Post-training static int8 quantization of the UNet for CPU-only inference. Dynamic quantization only covers linear and recurrent layers, while this model consists of convolutions, so the activation ranges are calibrated on synthetic `random_paste` composites instead. The quantized model takes the same `(x, outSize)` arguments as `UNet`, so it can be passed as the model to `predict_masks` or `run_streaming_pipeline`. It only accepts inputs of the size it was quantized for (512x512 by default, `input_size=(256, 256)` for the 256x256 composites of `evaluate_checkpoint`), and it always runs on the CPU: inputs on another device are copied to the CPU and the logits are copied back.
+"""
+
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+class QuantizedUNet(Module):
+  def __init__(self, quantized_model, input_size):
+    super().__init__()
+    self.quantized_model = quantized_model
+    self.input_size = tuple(input_size)
+
+  def forward(self, x, outSize=(256, 256)):
+    # the CenterCrop offsets of the traced model only fit one input size
+    if tuple(x.shape[-2:]) != self.input_size:
+      raise ValueError("This model was quantized for {}x{} inputs, got {}x{}; quantize it again with "
+                       "input_size={}".format(*self.input_size, *x.shape[-2:], tuple(x.shape[-2:])))
+    # the quantized kernels only run on the CPU; the interpolation to the
+    # output size runs in float
+    return F.interpolate(self.quantized_model(x.cpu()), outSize).to(x.device)
+
+# Calibrates and converts model for inputs of input_size (the CenterCrop
+# offsets are fixed for one input size). The calibration composites are
+# resized to input_size, like the 512x512 test image.
+def quantize_unet(model, calibration_images, input_size=(512, 512), batch_size=8):
+  # conv1 + ReLU are fused by prepare_fx itself
+  fused = FusedUNet(model, input_size, output_size=None, fuse=False).eval()
+  # The quantized ConvTranspose2d kernels of the x86 and fbgemm engines
+  # produce wrong outputs for this model, so the two upsampling layers stay in
+  # float. They are a small part of the compute.
+  qconfig_mapping = get_default_qconfig_mapping(torch.backends.quantized.engine)
+  qconfig_mapping.set_object_type(ConvTranspose2d, None)
+  example = torch.zeros(1, 3, *input_size)
+  prepared = prepare_fx(fused, qconfig_mapping, example_inputs=(example,))
+  with torch.inference_mode():
+    for batch_start in range(0, calibration_images.shape[0], batch_size):
+      batch = calibration_images[batch_start:batch_start + batch_size]
+      prepared(F.interpolate(batch, input_size, mode='bilinear', align_corners=False))
+  return QuantizedUNet(convert_fx(prepared), input_size).eval()
+
+# IoU between the fp32 and int8 masks, the relative difference of their convex
+# hull areas and the per-image latency of both models
+def compare_quantized_unet(model, quantized_model, images, output_size=(512, 512)):
+  model = model.cpu().eval()
+  fp32_masks, int8_masks = [], []
+  timings = {'fp32': 0.0, 'int8': 0.0}
+  with torch.inference_mode():
+    for image in images:
+      for name, masks, m in [('fp32', fp32_masks, model), ('int8', int8_masks, quantized_model)]:
+        start = time.perf_counter()
+        masks.append((m(image[None], output_size) > 0.5)[0, 0])
+        timings[name] += time.perf_counter() - start
+  ious, area_deltas = [], []
+  for fp32_mask, int8_mask in zip(fp32_masks, int8_masks):
+    union = (fp32_mask | int8_mask).sum().item()
+    ious.append((fp32_mask & int8_mask).sum().item() / union if union else 1.0)
+    fp32_area = mask_hull_area(fp32_mask.byte())
+    area_deltas.append(abs(mask_hull_area(int8_mask.byte()) - fp32_area) / max(fp32_area, 1.0))
+  return {
+      'iou': float(np.mean(ious)),
+      'hull_area_delta': float(np.mean(area_deltas)),
+      'fp32_ms': timings['fp32'] / len(images) * 1000,
+      'int8_ms': timings['int8'] / len(images) * 1000,
+  }
+
+## NOTE: Only used for deployment. This section can be skipped.
+
+calibration_images = torch.stack([train_dataset[i][0] for i in range(64)])
+fp32_unet = get_unet(model_save_location + '/checkpoint36.pt', 'cpu')
+quantized_unet = quantize_unet(fp32_unet, calibration_images)
+
+# evaluated on the test image and the held-out validation composites,
+# resized to the test image resolution
+comparison_images = torch.cat([
+    test_image_tensor[None],
+    F.interpolate(validation_images[:31], (512, 512), mode='bilinear', align_corners=False),
+])
+report = compare_quantized_unet(fp32_unet, quantized_unet, comparison_images)
+print("IoU vs fp32: {iou:.4f}, hull area delta: {hull_area_delta:.2%}, "
+      "latency fp32: {fp32_ms:.1f} ms, int8: {int8_ms:.1f} ms".format(**report))
+
+# the quantized model plugs into the batched inference path
+quantized_masks = dict(predict_masks([test_image_tensor], model=quantized_unet))
+
+"""# Streaming pipeline
+Segmentation, convex hull and area run as separate stages connected by bounded queues: a thread decodes the images, the model runs on the main thread, and a process pool computes the CPU-bound geometry. The model and the geometry work therefore overlap, and every image produces one JSON line with its hull vertices (as [row, col] pairs), area and per-stage latencies.
+"""
+
+import threading
+from collections import deque
+
+# Runs in a pool worker: computes the hull and area of one RowRunMask
+def measure_hull_and_area(row_run_mask):
+  start = time.perf_counter()
+  polygon_points_n2 = row_run_mask.polygon()
+  area = calculate_polygon_area_fast(polygon_points_n2)
+  return {
+      'foreground_pixels': row_run_mask.foreground_pixels(),
+      'hull_vertices': int(polygon_points_n2.shape[0]),
+      'hull': polygon_points_n2.tolist(),
+      'area': area,
+      'geometry_ms': (time.perf_counter() - start) * 1000,
+  }
+
+def limit_worker_threads():
+  torch.set_num_threads(1)
+
+# Decodes the images on a background thread. Every queue item is
+# (key, image, time the decode started, decode time); end_of_images marks the
+# end and an exception is forwarded to the consumer.
+end_of_images = object()
+
+def decode_images_into_queue(images, decoded_queue):
+  try:
+    image_iterator = iterate_images(images)
+    while True:
+      start = time.perf_counter()
+      item = next(image_iterator, None)
+      if item is None:
+        break
+      key, image = item
+      decoded_queue.put((key, image, start, time.perf_counter() - start))
+    decoded_queue.put(end_of_images)
+  except Exception as e:
+    decoded_queue.put(e)
+
+# Takes up to batch_size decoded images of the same size without waiting for
+# more images to arrive, so a slow decoder doesn't hold back the model. The
+# first queue item that doesn't fit into the batch is returned as well.
+def take_batch(decoded_queue, first_item, batch_size):
+  batch = [first_item]
+  size = first_item[1].shape[-2:]
+  leftover = None
+  while len(batch) < batch_size:
+    try:
+      item = decoded_queue.get_nowait()
+    except queue.Empty:
+      break
+    if isinstance(item, Exception) or item is end_of_images or item[1].shape[-2:] != size:
+      leftover = item
+      break
+    batch.append(item)
+  return batch, leftover
+
+# Runs decode -> UNet -> hull -> area over the images and writes one JSON
+# record per image to output_path, in input order. At most queue_size decoded
+# images and max_pending masks are held in memory at any time. Returns the
+# throughput and the mean latency of every stage.
+def run_streaming_pipeline(images, output_path, model=None, batch_size=8, queue_size=32,
+                           max_pending=64, num_workers=None):
+  model = unet if model is None else model
+  model.eval()
+  decoded_queue = queue.Queue(maxsize=queue_size)
+  decoder = threading.Thread(target=decode_images_into_queue, args=(images, decoded_queue), daemon=True)
+  totals = {'decode_ms': 0.0, 'inference_ms': 0.0, 'geometry_ms': 0.0, 'latency_ms': 0.0}
+  num_images = 0
+  start = time.perf_counter()
+  pending = deque()
+
+  def write_oldest(output_file):
+    nonlocal num_images
+    key, decode_start, timings, future = pending.popleft()
+    record = {'image': key}
+    record.update(future.result())
+    record.update(timings)
+    record['latency_ms'] = (time.perf_counter() - decode_start) * 1000
+    for name in totals:
+      totals[name] += record[name]
+    num_images += 1
+    output_file.write(json.dumps(record) + '\n')
+
+  pool = ProcessPoolExecutor(num_workers, mp_context=multiprocessing.get_context('fork'),
+                             initializer=limit_worker_threads)
+  # the fork context starts all workers on the first submit; forking while the
+  # decoder thread runs can deadlock the children, so they are started first
+  pool.submit(os.getpid).result()
+  decoder.start()
+  try:
+    with open(output_path, 'w') as output_file, torch.inference_mode():
+      item = decoded_queue.get()
+      while item is not end_of_images:
+        if isinstance(item, Exception):
+          raise item
+        batch, item = take_batch(decoded_queue, item, batch_size)
+        inference_start = time.perf_counter()
+        images_batch = torch.stack([image for _, image, _, _ in batch]).to(device)
+        # only the row runs of the masks are sent to the pool workers
+        masks = list(map(RowRunMask.from_logits, model(images_batch, tuple(images_batch.shape[-2:]))[:, 0]))
+        inference_ms = (time.perf_counter() - inference_start) * 1000 / len(batch)
+        for (key, _, decode_start, decode_s), mask in zip(batch, masks):
+          timings = {'decode_ms': decode_s * 1000, 'inference_ms': inference_ms}
+          pending.append((key, decode_start, timings, pool.submit(measure_hull_and_area, mask)))
+          while len(pending) > max_pending:
+            write_oldest(output_file)
+        if item is None:
+          item = decoded_queue.get()
+      while pending:
+        write_oldest(output_file)
+  finally:
+    pool.shutdown(cancel_futures=True)
+
+  elapsed = time.perf_counter() - start
+  summary = {'images': num_images, 'images_per_sec': num_images / elapsed if elapsed > 0 else 0.0}
+  for name, total in totals.items():
+    summary['mean_' + name] = total / num_images if num_images else 0.0
+  return summary
+
+## NOTE: This section can be skipped.
+
+print(run_streaming_pipeline([test_image_tensor] * 8, 'pipeline_records.jsonl'))
+
+"""# Benchmark suite
+Times every stage of the script on fixed synthetic inputs: `random_paste`, an epoch of the `RandomPasteTurtleDataset` training loader, the UNet forward and forward/backward passes at 256 and 512, `get_mask_from_image`, the convex hull and the polygon area. The hull and the area are also timed over a sweep of foreground pixel counts. The results go into a JSON file that carries the git commit, so runs from two commits can be compared with `compare_benchmark_results`. With `profile='cprofile'` or `profile='torch'` every stage is additionally run once under cProfile or the torch profiler, and the profiles are written next to the JSON file.
+"""
+
+import cProfile
+import datetime
+import platform
+
+def benchmark_metadata():
+  try:
+    commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+  except (OSError, subprocess.CalledProcessError):
+    commit = None
+  return {
+      'commit': commit,
+      'time': datetime.datetime.now().isoformat(timespec='seconds'),
+      'python': platform.python_version(),
+      'torch': torch.__version__,
+      'device': str(device),
+      'num_threads': torch.get_num_threads(),
+  }
+
+# Runs fn once under the given profiler and writes the profile to
+# profile_dir/name.prof (cProfile) or profile_dir/name.trace.json (a chrome
+# trace of the torch profiler)
+def profile_stage(name, fn, profile, profile_dir):
+  os.makedirs(profile_dir, exist_ok=True)
+  if profile == 'cprofile':
+    profiler = cProfile.Profile()
+    profiler.runcall(fn)
+    profiler.dump_stats(os.path.join(profile_dir, name + '.prof'))
+  elif profile == 'torch':
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if device.type == "cuda":
+      activities.append(torch.profiler.ProfilerActivity.CUDA)
+    with torch.profiler.profile(activities=activities, record_shapes=True) as profiler:
+      fn()
+    profiler.export_chrome_trace(os.path.join(profile_dir, name + '.trace.json'))
+  else:
+    raise ValueError("Unknown profiler: {}".format(profile))
+
+# Milliseconds per call of fn, after warmup calls that are not timed
+def time_stage(fn, repeats=5, warmup=1):
+  for _ in range(warmup):
+    fn()
+  times = []
+  for _ in range(repeats):
+    start = time.perf_counter()
+    fn()
+    if device.type == "cuda":
+      torch.cuda.synchronize()
+    times.append((time.perf_counter() - start) * 1000)
+  times = np.array(times)
+  return {'median_ms': float(np.median(times)), 'min_ms': float(times.min()),
+          'mean_ms': float(times.mean()), 'repeats': repeats}
+
+# Fixed inputs for the benchmarks: noise backgrounds and a 512x512 test image
+# from the same seed
+def make_benchmark_inputs(num_samples=64, seed=0):
+  np_rng = np.random.RandomState(seed)
+  backgrounds = [Image.fromarray(np_rng.randint(0, 256, size=(256, 256, 3), dtype=np.uint8))
+                 for _ in range(num_samples)]
+  test_image = torch.from_numpy(np_rng.rand(3, 512, 512).astype(np.float32))
+  return backgrounds, test_image
+
+def benchmark_unet_step(model, images, masks, backward):
+  if not backward:
+    with torch.inference_mode():
+      model(images, tuple(images.shape[-2:]))
+    return
+  model.zero_grad(set_to_none=True)
+  loss = BCEWithLogitsLoss()(model(images, tuple(images.shape[-2:])), masks)
+  loss.backward()
+
+# Hull and area time against the number of foreground pixels, on ellipse masks
+# of growing size. Gift wrapping is O(nv) and is skipped above jarvis_max_pixels.
+def benchmark_geometry_scaling(resolution=512, fills=(0.01, 0.02, 0.05, 0.1, 0.2, 0.4), repeats=3,
+                               jarvis_max_pixels=30000):
+  curve = []
+  for fill in fills:
+    bench_mask = make_ellipse_mask(resolution, fill)
+    row_run_mask = RowRunMask.from_mask(bench_mask)
+    polygon_points_n2 = get_tight_polygon_from_mask_fast(bench_mask)
+    point = {
+        'foreground_pixels': int(bench_mask.sum()),
+        'hull_vertices': int(polygon_points_n2.shape[0]),
+        'monotone_chain_ms': time_stage(lambda: get_tight_polygon_from_mask_fast(bench_mask), repeats)['median_ms'],
+        'row_runs_ms': time_stage(row_run_mask.polygon, repeats)['median_ms'],
+        'area_ms': time_stage(lambda: calculate_polygon_area(polygon_points_n2), repeats)['median_ms'],
+        'area_fast_ms': time_stage(lambda: calculate_polygon_area_fast(polygon_points_n2), repeats)['median_ms'],
+    }
+    if point['foreground_pixels'] <= jarvis_max_pixels:
+      point['jarvis_ms'] = time_stage(lambda: get_tight_polygon_from_mask(bench_mask), 1, 0)['median_ms']
+    curve.append(point)
+  return curve
+
+# The dataset stage iterates the training loader setup (batches of 16,
+# loader_workers workers reseeded by seed_dataset_worker)
+def run_benchmark_suite(output_path='benchmarks.json', repeats=5, batch_size=4, loader_workers=8, profile=None,
+                        profile_dir=None):
+  backgrounds, test_image = make_benchmark_inputs()
+  background = backgrounds[0]
+  bench_mask = make_ellipse_mask(512, 0.05)
+  polygon_points_n2 = get_tight_polygon_from_mask_fast(bench_mask)
+  torch.manual_seed(0)
+  bench_unet = UNet().to(device)
+  rng = random.Random(0)
+
+  def iterate_dataset():
+    torch.manual_seed(0)
+    loader = DataLoader(RandomPasteTurtleDataset(backgrounds, turtle_image_256x256), batch_size=16, shuffle=True,
+                        num_workers=loader_workers, worker_init_fn=seed_dataset_worker if loader_workers > 0 else None)
+    for _ in loader:
+      pass
+
+  stages = {
+      'random_paste': lambda: make_training_pair(*random_paste(background.copy(), turtle_image_256x256.copy(), rng=rng)),
+      'random_paste_dataset_epoch_{}'.format(len(backgrounds)): iterate_dataset,
+      'get_mask_from_image': lambda: get_mask_from_image(test_image),
+      'get_tight_polygon_from_mask': lambda: get_tight_polygon_from_mask(bench_mask),
+      'get_tight_polygon_from_mask_fast': lambda: get_tight_polygon_from_mask_fast(bench_mask),
+      'calculate_polygon_area': lambda: calculate_polygon_area(polygon_points_n2),
+      'calculate_polygon_area_fast': lambda: calculate_polygon_area_fast(polygon_points_n2),
+  }
+  for resolution in (256, 512):
+    images = torch.rand(batch_size, 3, resolution, resolution, device=device)
+    masks = (torch.rand(batch_size, 1, resolution, resolution, device=device) > 0.5).float()
+    for backward in (False, True):
+      name = 'unet_{}_{}_batch{}'.format('forward_backward' if backward else 'forward', resolution, batch_size)
+      stages[name] = functools.partial(benchmark_unet_step, bench_unet, images, masks, backward)
+
+  results = {'metadata': benchmark_metadata(), 'stages': {}}
+  profile_dir = profile_dir or os.path.splitext(output_path)[0] + '_profiles'
+  for name, fn in stages.items():
+    # gift wrapping is slow enough that a single run without warmup is
+    # representative
+    if name == 'get_tight_polygon_from_mask':
+      results['stages'][name] = time_stage(fn, 1, 0)
+    else:
+      results['stages'][name] = time_stage(fn, repeats)
+    if profile is not None:
+      profile_stage(name, fn, profile, profile_dir)
+    print("{}: {:.2f} ms".format(name, results['stages'][name]['median_ms']))
+  results['geometry_scaling'] = benchmark_geometry_scaling()
+
+  with open(output_path, 'w') as f:
+    json.dump(results, f, indent=2)
+  return results
+
+# Prints the change of every stage between two benchmark files and returns the
+# stages that got slower by more than the tolerance
+def compare_benchmark_results(baseline_path, current_path, tolerance=1.2):
+  with open(baseline_path) as f:
+    baseline = json.load(f)
+  with open(current_path) as f:
+    current = json.load(f)
+  regressions = []
+  for name, stats in current['stages'].items():
+    if name not in baseline['stages']:
+      continue
+    ratio = stats['median_ms'] / baseline['stages'][name]['median_ms']
+    if ratio > tolerance:
+      regressions.append(name)
+    print("{}: {:.2f} ms -> {:.2f} ms ({:.2f}x){}".format(
+        name, baseline['stages'][name]['median_ms'], stats['median_ms'], ratio,
+        " REGRESSION" if ratio > tolerance else ""))
+  return regressions
+
+## NOTE: Only used for benchmarking. This section can be skipped.
+
+benchmark_results = run_benchmark_suite('benchmarks.json')
+for point in benchmark_results['geometry_scaling']:
+  print(point)
+
+"""# Service metrics
+`measure_image` runs one image through decode -> `ToTensor` -> UNet -> threshold -> hull -> area and reports every stage to a metrics object: a latency histogram per stage, counters of the foreground pixels and hull vertices, and histograms of both, so latency spikes can be tied to the mask size. `PrometheusMetrics` keeps these in memory and renders them in the Prometheus text format; the default `null_metrics` does nothing, and when it is used no timer is started and the device is never synchronized.
+"""
+
+import bisect
+import io
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds of the histogram buckets
+latency_buckets_s = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+pixel_count_buckets = (1000, 2500, 5000, 10000, 25000, 50000, 100000, 250000, 1000000)
+vertex_count_buckets = (8, 16, 32, 64, 128, 256, 512, 1024)
+
+class NullTimer:
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    return False
+
+null_timer = NullTimer()
+
+# The metrics interface. Every method is a no-op here, so the instrumented code
+# costs one attribute lookup per call when metrics are disabled; subclasses
+# override what they record.
+class Metrics:
+  enabled = False
+
+  def timer(self, stage):
+    return null_timer
+
+  def observe(self, name, value, stage=None):
+    pass
+
+  def increment(self, name, value=1):
+    pass
+
+null_metrics = Metrics()
+
+class StageTimer:
+  def __init__(self, metrics, stage):
+    self.metrics = metrics
+    self.stage = stage
+
+  def __enter__(self):
+    self.start = time.perf_counter()
+    return self
+
+  def __exit__(self, *exc_info):
+    # CUDA kernels run asynchronously, so the stage ends when the device is done
+    if device.type == "cuda":
+      torch.cuda.synchronize()
+    self.metrics.observe('stage_seconds', time.perf_counter() - self.start, stage=self.stage)
+    return False
+
+class Histogram:
+  def __init__(self, buckets):
+    self.buckets = tuple(buckets)
+    self.counts = [0] * (len(self.buckets) + 1)
+    self.sum = 0.0
+
+  def observe(self, value):
+    self.counts[bisect.bisect_left(self.buckets, value)] += 1
+    self.sum += value
+
+class PrometheusMetrics(Metrics):
+  enabled = True
+
+  def __init__(self, namespace='turtle'):
+    self.namespace = namespace
+    self.lock = threading.Lock()
+    self.counters = {}
+    # (name, stage) -> Histogram
+    self.histograms = {}
+    self.histogram_buckets = {
+        'stage_seconds': latency_buckets_s,
+        'foreground_pixels_per_image': pixel_count_buckets,
+        'hull_vertices_per_image': vertex_count_buckets,
+    }
+
+  def timer(self, stage):
+    return StageTimer(self, stage)
+
+  def observe(self, name, value, stage=None):
+    with self.lock:
+      key = (name, stage)
+      if key not in self.histograms:
+        self.histograms[key] = Histogram(self.histogram_buckets.get(name, latency_buckets_s))
+      self.histograms[key].observe(value)
+
+  def increment(self, name, value=1):
+    with self.lock:
+      self.counters[name] = self.counters.get(name, 0) + value
+
+  def render(self):
+    lines = []
+    with self.lock:
+      for name, value in sorted(self.counters.items()):
+        metric = '{}_{}_total'.format(self.namespace, name)
+        lines += ['# TYPE {} counter'.format(metric), '{} {}'.format(metric, value)]
+      for name in sorted({name for name, _ in self.histograms}):
+        metric = '{}_{}'.format(self.namespace, name)
+        lines.append('# TYPE {} histogram'.format(metric))
+        for (histogram_name, stage), histogram in sorted(self.histograms.items(), key=lambda item: str(item[0])):
+          if histogram_name != name:
+            continue
+          labels = 'stage="{}",'.format(stage) if stage is not None else ''
+          cumulative = 0
+          for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+            cumulative += count
+            lines.append('{}_bucket{{{}le="{}"}} {}'.format(metric, labels, bound, cumulative))
+          labels = '{{{}}}'.format(labels.rstrip(',')) if labels else ''
+          lines.append('{}_sum{} {}'.format(metric, labels, histogram.sum))
+          lines.append('{}_count{} {}'.format(metric, labels, cumulative))
+    return '\n'.join(lines) + '\n'
+
+# Serves metrics.render() at /metrics on a background thread; call shutdown()
+# on the returned server to stop it
+def serve_metrics(metrics, port=9100, host='127.0.0.1'):
+  class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+      if self.path != '/metrics':
+        self.send_error(404)
+        return
+      body = metrics.render().encode()
+      self.send_response(200)
+      self.send_header('Content-Type', 'text/plain; version=0.0.4')
+      self.send_header('Content-Length', str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+    def log_message(self, *args):
+      pass
+
+  server = ThreadingHTTPServer((host, port), MetricsHandler)
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  return server
+
+# Runs one image through the whole pipeline. The image can be encoded bytes, a
+# path, a PIL image or a 3xHxW tensor; the decode and ToTensor stages are only
+# reported for the inputs that need them.
+def measure_image(image, model=None, metrics=null_metrics, threshold=0.5):
+  model = unet if model is None else model
+  if isinstance(image, (bytes, str)):
+    with metrics.timer('decode'):
+      with Image.open(io.BytesIO(image) if isinstance(image, bytes) else image) as encoded:
+        image = encoded.convert('RGB')
+  if isinstance(image, Image.Image):
+    with metrics.timer('to_tensor'):
+      image = tensor_transform(image)
+  with torch.inference_mode():
+    with metrics.timer('forward'):
+      logits = model(image.to(device)[None], tuple(image.shape[-2:]))[0, 0]
+    with metrics.timer('threshold'):
+      row_run_mask = RowRunMask.from_logits(logits, threshold)
+  with metrics.timer('hull'):
+    polygon_points_n2 = row_run_mask.polygon()
+  with metrics.timer('area'):
+    area = calculate_polygon_area_fast(polygon_points_n2)
+
+  foreground_pixels = row_run_mask.foreground_pixels()
+  hull_vertices = int(polygon_points_n2.shape[0])
+  if metrics.enabled:
+    metrics.increment('images')
+    metrics.increment('foreground_pixels', foreground_pixels)
+    metrics.increment('hull_vertices', hull_vertices)
+    metrics.observe('foreground_pixels_per_image', foreground_pixels)
+    metrics.observe('hull_vertices_per_image', hull_vertices)
+  return {'polygon': polygon_points_n2, 'area': area, 'foreground_pixels': foreground_pixels,
+          'hull_vertices': hull_vertices}
+
+## NOTE: This section can be skipped.
+
+# The instrumented path gives the same hull as the row run path, and the
+# disabled metrics add nothing measurable to it
+service_metrics = PrometheusMetrics()
+with open('./test.png', 'rb') as f:
+  test_png_bytes = f.read()
+result = measure_image(test_png_bytes, metrics=service_metrics)
+with torch.inference_mode():
+  assert torch.equal(result['polygon'], get_row_run_mask_from_image(test_image_tensor).polygon())
+print(service_metrics.render())
+print("disabled: {:.2f} ms, enabled: {:.2f} ms".format(
+    time_stage(lambda: measure_image(test_image_tensor))['median_ms'],
+    time_stage(lambda: measure_image(test_image_tensor, metrics=PrometheusMetrics()))['median_ms']))
+
+"""# Coarse-to-fine inference
+The UNet cost grows with the number of input pixels, but the convex hull only depends on where the mask boundary is. `predict_logits_coarse_to_fine` runs the model once on the image downscaled to `coarse_size`, upsamples the logits, and then re-runs the model at full resolution only on the tiles that overlap a band of `band_width` pixels around the coarse boundary. Outside the band the upsampled coarse logits are kept.
+"""
+
+# Pixels within band_width (full resolution) of the boundary of the coarse mask
+def boundary_band(coarse_logits_hw, size, band_width, threshold=0.5):
+  foreground = (coarse_logits_hw > threshold).float()[None, None]
+  dilated = F.max_pool2d(foreground, 3, 1, 1)
+  eroded = -F.max_pool2d(-foreground, 3, 1, 1)
+  edge = F.interpolate(dilated - eroded, size, mode='nearest')
+  return F.max_pool2d(edge, 2 * band_width + 1, 1, band_width)[0, 0] > 0
+
+# Returns the full resolution logits and the fraction of the image that was
+# run at full resolution. Both passes use the context padded model of
+# predict_logits_padded, so the coarse logits and the refined tiles are
+# aligned with the image, and the band is refined exactly as the full image
+# would be.
+def predict_logits_coarse_to_fine(model, image, coarse_size=256, band_width=8, tile_size=128, batch_size=8,
+                                  threshold=0.5):
+  _, h, w = image.shape
+  coarse_image = F.interpolate(image[None], (coarse_size, coarse_size), mode='bilinear', align_corners=False)
+  coarse_logits = predict_logits_padded(model, coarse_image[0])[None, None]
+  logits = F.interpolate(coarse_logits, (h, w), mode='bilinear', align_corners=False)[0, 0]
+  band = boundary_band(coarse_logits[0, 0], (h, w), band_width, threshold)
+
+  padded, out_size = pad_with_context(image)
+  corners, tile_h, tile_w = tile_corners(out_size, tile_size)
+  corners = [(y, x) for y, x in corners if band[y:y + tile_h, x:x + tile_w].any()]
+  refined = torch.zeros(out_size, device=image.device)
+  predict_tiles(model, padded, corners, tile_h, tile_w, batch_size, refined)
+  # every band pixel lies in one of the tiles
+  logits = torch.where(band, refined[:h, :w], logits)
+  # tiles can overlap at the image border, so the union of the tiles is counted
+  covered = torch.zeros(out_size, dtype=torch.bool)
+  for y, x in corners:
+    covered[y:y + tile_h, x:x + tile_w] = True
+  return logits, covered[:h, :w].float().mean().item()
+
+def get_mask_from_image_coarse_to_fine(test_image, **kwargs):
+  with torch.inference_mode():
+    logits, _ = predict_logits_coarse_to_fine(unet, test_image.to(device), **kwargs)
+  return (logits > 0.5).byte()
+
+# Speedup, mask IoU and hull area delta of the coarse-to-fine masks against
+# full resolution inference (predict_logits_padded), averaged over the images
+def compare_coarse_to_fine(model, images, repeats=3, **kwargs):
+  model.eval()
+  full_ms, coarse_ms, ious, area_deltas, refined_fractions = [], [], [], [], []
+  with torch.inference_mode():
+    for image in images:
+      image = image.to(device)
+      full_ms.append(time_stage(lambda: predict_logits_padded(model, image), repeats)['median_ms'])
+      coarse_ms.append(time_stage(lambda: predict_logits_coarse_to_fine(model, image, **kwargs), repeats)['median_ms'])
+      full_mask = (predict_logits_padded(model, image) > 0.5).cpu()
+      logits, refined_fraction = predict_logits_coarse_to_fine(model, image, **kwargs)
+      coarse_mask = (logits > 0.5).cpu()
+      union = (full_mask | coarse_mask).sum().item()
+      ious.append((full_mask & coarse_mask).sum().item() / union if union else 1.0)
+      full_area = mask_hull_area(full_mask.byte())
+      area_deltas.append(abs(mask_hull_area(coarse_mask.byte()) - full_area) / max(full_area, 1.0))
+      refined_fractions.append(refined_fraction)
+  return {
+      'speedup': float(np.sum(full_ms) / np.sum(coarse_ms)),
+      'full_ms': float(np.mean(full_ms)),
+      'coarse_to_fine_ms': float(np.mean(coarse_ms)),
+      'refined_fraction': float(np.mean(refined_fractions)),
+      'iou': float(np.mean(ious)),
+      'hull_area_delta': float(np.mean(area_deltas)),
+  }
+
+## NOTE: Only used for benchmarking. This section can be skipped.
+
+# On the test image and on the test image upscaled to 1024 and 2048
+for resolution in (512, 1024, 2048):
+  scaled_image = F.interpolate(test_image_tensor[None], (resolution, resolution), mode='bilinear',
+                               align_corners=False)[0]
+  report = compare_coarse_to_fine(unet, [scaled_image])
+  print("{}x{}: {speedup:.2f}x faster ({full_ms:.1f} ms -> {coarse_to_fine_ms:.1f} ms), "
+        "{refined_fraction:.0%} refined, IoU {iou:.4f}, hull area delta {hull_area_delta:.2%}".format(
+            resolution, resolution, **report))
+
+"""# Inference server
+`InferenceServer` is an asyncio HTTP server for other services: `POST /segment` with an encoded image in the body returns the foreground pixel count, the hull vertices and the hull area as JSON, and `GET /stats` returns the latency percentiles, throughput, mean batch size and failed requests so far. Requests are queued and coalesced into micro-batches of up to `max_batch_size` images; a batch is closed `max_wait_ms` after its first request arrived. The UNet runs on a single worker thread, so the event loop keeps accepting requests, and the hull and area go to the same process pool workers as in the streaming pipeline. `run_load` is a local load generator that reports the same statistics from the client side.
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+def latency_summary(latencies_ms, elapsed_s):
+  latencies_ms = np.asarray(latencies_ms, dtype=np.float64)
+  if latencies_ms.shape[0] == 0:
+    return {'requests': 0, 'requests_per_sec': 0.0, 'p50_ms': 0.0, 'p99_ms': 0.0}
+  return {
+      'requests': int(latencies_ms.shape[0]),
+      'requests_per_sec': latencies_ms.shape[0] / elapsed_s if elapsed_s > 0 else 0.0,
+      'p50_ms': float(np.percentile(latencies_ms, 50)),
+      'p99_ms': float(np.percentile(latencies_ms, 99)),
+  }
+
+def decode_image_bytes(data):
+  with Image.open(io.BytesIO(data)) as image:
+    return tensor_transform(image.convert('RGB'))
+
+class InferenceServer:
+  def __init__(self, model=None, max_batch_size=8, max_wait_ms=5.0, num_workers=None, max_queue_size=256,
+               max_body_bytes=32 * 2 ** 20):
+    self.model = (unet if model is None else model).eval()
+    self.max_batch_size = max_batch_size
+    self.max_wait_ms = max_wait_ms
+    self.max_queue_size = max_queue_size
+    # larger request bodies are rejected before they are read
+    self.max_body_bytes = max_body_bytes
+    self.model_thread = ThreadPoolExecutor(1)
+    self.geometry_pool = ProcessPoolExecutor(num_workers, mp_context=multiprocessing.get_context('fork'),
+                                             initializer=limit_worker_threads)
+    # the fork context starts all workers on the first submit, so they are
+    # forked here rather than from a thread of the running server
+    self.geometry_pool.submit(os.getpid).result()
+    self.latencies_ms = []
+    self.batch_sizes = []
+    self.errors = 0
+    self.last_error = None
+    self.start_time = None
+    self.server = None
+
+  async def start(self, host='127.0.0.1', port=8080, path=None):
+    self.queue = asyncio.Queue(self.max_queue_size)
+    self.batcher = asyncio.ensure_future(self.run_batches())
+    self.start_time = time.perf_counter()
+    if path is not None:
+      self.server = await asyncio.start_unix_server(self.handle_connection, path)
+    else:
+      self.server = await asyncio.start_server(self.handle_connection, host, port)
+    return self.server
+
+  async def stop(self):
+    self.server.close()
+    await self.server.wait_closed()
+    self.batcher.cancel()
+    self.model_thread.shutdown()
+    self.geometry_pool.shutdown(cancel_futures=True)
+
+  def stats(self):
+    summary = latency_summary(self.latencies_ms, time.perf_counter() - self.start_time)
+    summary['mean_batch_size'] = float(np.mean(self.batch_sizes)) if self.batch_sizes else 0.0
+    summary['errors'] = self.errors
+    summary['last_error'] = self.last_error
+    return summary
+
+  def fail(self, futures, error):
+    self.errors += len(futures)
+    self.last_error = repr(error)
+    for future in futures:
+      if not future.done():
+        future.set_exception(error)
+
+  async def segment(self, data):
+    loop = asyncio.get_running_loop()
+    image = await loop.run_in_executor(None, decode_image_bytes, data)
+    future = loop.create_future()
+    await self.queue.put((image, future, loop.time()))
+    return await future
+
+  # Waits for the first request, then collects more until the batch is full or
+  # max_wait_ms have passed since the first request was queued. A request that
+  # waited through the previous model call therefore doesn't wait again; its
+  # batch only takes the requests that are already queued.
+  async def take_batch(self):
+    batch = [await self.queue.get()]
+    deadline = batch[0][2] + self.max_wait_ms / 1000
+    while len(batch) < self.max_batch_size:
+      timeout = deadline - asyncio.get_running_loop().time()
+      try:
+        if timeout <= 0:
+          batch.append(self.queue.get_nowait())
+        else:
+          batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+      except (asyncio.QueueEmpty, asyncio.TimeoutError):
+        break
+    return batch
+
+  def predict_row_run_masks(self, images):
+    with torch.inference_mode():
+      logits = self.model(torch.stack(images).to(device), tuple(images[0].shape[-2:]))[:, 0]
+      return list(map(RowRunMask.from_logits, logits))
+
+  async def run_batches(self):
+    loop = asyncio.get_running_loop()
+    while True:
+      batch = await self.take_batch()
+      self.batch_sizes.append(len(batch))
+      # images of different sizes can't be stacked, so they are run separately
+      by_size = {}
+      for image, future, _ in batch:
+        by_size.setdefault(tuple(image.shape[-2:]), []).append((image, future))
+      for group in by_size.values():
+        images, futures = zip(*group)
+        try:
+          masks = await loop.run_in_executor(self.model_thread, self.predict_row_run_masks, images)
+        except Exception as e:
+          self.fail(futures, e)
+          continue
+        for mask, future in zip(masks, futures):
+          # the next batch can run on the model thread while the pool works.
+          # If a pool worker died, the pool is broken for good and every
+          # request fails with BrokenProcessPool instead of hanging.
+          try:
+            geometry = asyncio.wrap_future(self.geometry_pool.submit(measure_hull_and_area, mask))
+          except BrokenProcessPool as e:
+            self.fail([future], e)
+            continue
+          geometry.add_done_callback(functools.partial(self.resolve, future))
+
+  def resolve(self, future, geometry):
+    if future.cancelled():
+      return
+    if geometry.exception() is not None:
+      self.fail([future], geometry.exception())
+    else:
+      future.set_result(geometry.result())
+
+  # Reads one request and returns (method, target, headers, body), or None at
+  # the end of the connection. Malformed requests raise ValueError.
+  async def read_request(self, reader):
+    # readline raises ValueError for lines over the stream limit (64 KB)
+    request_line = await reader.readline()
+    if not request_line:
+      return None
+    parts = request_line.decode('latin-1').split()
+    if len(parts) != 3:
+      raise ValueError("Malformed request line")
+    method, target, _ = parts
+    headers = {}
+    while True:
+      line = await reader.readline()
+      if line in (b'\r\n', b'\n', b''):
+        break
+      name, separator, value = line.decode('latin-1').partition(':')
+      if not separator:
+        raise ValueError("Malformed header")
+      headers[name.strip().lower()] = value.strip()
+    content_length = int(headers.get('content-length', 0))
+    if not 0 <= content_length <= self.max_body_bytes:
+      raise ValueError("Content-Length must be between 0 and {}".format(self.max_body_bytes))
+    return method, target, headers, await reader.readexactly(content_length)
+
+  def write_response(self, writer, status, result):
+    response = json.dumps(result).encode()
+    reason = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error'}[status]
+    writer.write('HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n\r\n'.format(
+        status, reason, len(response)).encode() + response)
+
+  async def handle_connection(self, reader, writer):
+    try:
+      while True:
+        try:
+          request = await self.read_request(reader)
+        except ValueError as e:
+          # the rest of the stream can't be parsed, so the connection is closed
+          self.write_response(writer, 400, {'error': str(e)})
+          await writer.drain()
+          break
+        if request is None:
+          break
+        method, target, headers, body = request
+
+        start = time.perf_counter()
+        if method == 'POST' and target == '/segment':
+          try:
+            status, result = 200, await self.segment(body)
+            self.latencies_ms.append((time.perf_counter() - start) * 1000)
+          except Exception as e:
+            status, result = 500, {'error': repr(e)}
+        elif method == 'GET' and target == '/stats':
+          status, result = 200, self.stats()
+        else:
+          status, result = 404, {'error': 'not found'}
+        self.write_response(writer, status, result)
+        await writer.drain()
+        if headers.get('connection', '').lower() == 'close':
+          break
+    except (ConnectionError, asyncio.IncompleteReadError):
+      pass
+    finally:
+      writer.close()
+
+async def send_request(reader, writer, method, target, body=b''):
+  writer.write('{} {} HTTP/1.1\r\nHost: localhost\r\nContent-Length: {}\r\n\r\n'.format(
+      method, target, len(body)).encode() + body)
+  await writer.drain()
+  status = int((await reader.readline()).split()[1])
+  headers = {}
+  while True:
+    line = await reader.readline()
+    if line in (b'\r\n', b'\n', b''):
+      break
+    name, value = line.decode('latin-1').split(':', 1)
+    headers[name.strip().lower()] = value.strip()
+  response = json.loads(await reader.readexactly(int(headers['content-length'])))
+  if status != 200:
+    raise RuntimeError("{} {} failed with {}: {}".format(method, target, status, response))
+  return response
+
+# Sends num_requests copies of image_bytes over concurrency keep-alive
+# connections and reports the client side latency percentiles and throughput
+async def run_load(image_bytes, num_requests=256, concurrency=16, host='127.0.0.1', port=8080, path=None):
+  latencies_ms = []
+  remaining = iter(range(num_requests))
+
+  async def client():
+    if path is not None:
+      reader, writer = await asyncio.open_unix_connection(path)
+    else:
+      reader, writer = await asyncio.open_connection(host, port)
+    try:
+      for _ in remaining:
+        start = time.perf_counter()
+        await send_request(reader, writer, 'POST', '/segment', image_bytes)
+        latencies_ms.append((time.perf_counter() - start) * 1000)
+    finally:
+      writer.close()
+
+  start = time.perf_counter()
+  await asyncio.gather(*(client() for _ in range(concurrency)))
+  return latency_summary(latencies_ms, time.perf_counter() - start)
+
+# Runs a coroutine to completion on a fresh event loop in another thread, so it
+# also works where an event loop is already running (e.g. in a notebook)
+def run_coroutine(coroutine):
+  with ThreadPoolExecutor(1) as executor:
+    return executor.submit(asyncio.run, coroutine).result()
+
+# Starts the server on an event loop of its own on a background thread.
+# Returns the server, its loop and the thread; stop them with
+# stop_server_thread.
+def start_server_thread(server, **kwargs):
+  loop = asyncio.new_event_loop()
+  thread = threading.Thread(target=loop.run_forever, daemon=True)
+  thread.start()
+  asyncio.run_coroutine_threadsafe(server.start(**kwargs), loop).result()
+  return server, loop, thread
+
+def stop_server_thread(server, loop, thread):
+  asyncio.run_coroutine_threadsafe(server.stop(), loop).result()
+  # the decode threads of the default executor would outlive the loop
+  asyncio.run_coroutine_threadsafe(loop.shutdown_default_executor(), loop).result()
+  loop.call_soon_threadsafe(loop.stop)
+  thread.join()
+  loop.close()
+
+## NOTE: Only used for benchmarking. This section can be skipped.
+
+# Load test with different batching limits; max_batch_size=1 is the unbatched
+# baseline
+for max_batch_size, max_wait_ms in [(1, 0.0), (8, 5.0), (16, 10.0)]:
+  inference_server, server_loop, server_thread = start_server_thread(
+      InferenceServer(max_batch_size=max_batch_size, max_wait_ms=max_wait_ms), port=8080)
+  client_stats = run_coroutine(run_load(test_png_bytes, num_requests=128, concurrency=16, port=8080))
+  server_stats = inference_server.stats()
+  stop_server_thread(inference_server, server_loop, server_thread)
+  print("max_batch_size={}, max_wait_ms={}: {requests_per_sec:.1f} req/s, p50 {p50_ms:.1f} ms, "
+        "p99 {p99_ms:.1f} ms".format(max_batch_size, max_wait_ms, **client_stats),
+        "mean batch size {:.1f}".format(server_stats['mean_batch_size']))
+
 """**Final Notes:**
 
 Trained checkpoints and results are stored in the following public link:
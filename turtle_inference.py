@@ -0,0 +1,34 @@
+"""Inference-only loader for the exported turtle segmentation model.
+
+The model is exported by `export_unet_torchscript` in
+deeplearning_turtlechallenge.py. This module only imports torch at load time,
+so it starts much faster than running the notebook.
+
+    model = load_segmenter('turtle_unet_512.pt')
+    mask = predict_mask(model, load_image('test.png'))
+"""
+import torch
+
+
+def load_segmenter(path, device='cpu'):
+  model = torch.jit.load(path, map_location=device)
+  model.eval()
+  return model
+
+
+def load_image(path):
+  # 3xHxW float tensor in [0, 1], like transforms.ToTensor
+  import numpy as np
+  from PIL import Image
+
+  with Image.open(path) as image:
+    array = np.asarray(image.convert('RGB'), dtype=np.uint8)
+  return torch.from_numpy(array.copy()).permute(2, 0, 1).float() / 255
+
+
+def predict_mask(model, image, device='cpu'):
+  # image must have the size the model was exported for;
+  # the mask is thresholded like get_mask_from_image
+  with torch.inference_mode():
+    logits = model(image.to(device)[None])
+  return (logits[0, 0] > 0.5).byte()